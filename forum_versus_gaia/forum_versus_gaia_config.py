@@ -3,7 +3,12 @@
 Various settings and utility functions for the forum_versus_gaia project.
 """
 import asyncio
+import random
+import time
+from collections import defaultdict
 from functools import partial
+from typing import Any, Callable
+from weakref import WeakKeyDictionary
 
 from agentforum.ext.llms.openai import openai_chat_completion, _message_to_openai_dict
 from agentforum.forum import Forum
@@ -12,8 +17,16 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+import openai
 import promptlayer
 
+from forum_versus_gaia.response_store import (
+    acalculate_prompt_sha256,
+    arun_in_store_thread,
+    get_response,
+    put_response,
+)
+
 async_openai_client = promptlayer.openai.AsyncOpenAI()
 
 FAST_GPT = "gpt-3.5-turbo-0125"
@@ -22,11 +35,83 @@ SLOW_GPT = "gpt-4-0125-preview"
 # SLOW_GPT = "gpt-3.5-turbo-0125"
 
 REMOVE_GAIA_LINKS = True
+# if False, html pages are converted to markdown with html2text (slower, but more of the page layout survives)
+FAST_HTML_CONVERSION = True
+
+LLM_CONCURRENCY_LIMIT = 16
+SERPAPI_CONCURRENCY_LIMIT = 4
+MAX_RATE_LIMIT_RETRIES = 3
+LLM_REQUESTS_PER_SECOND = 8  # per model
+SERPAPI_REQUESTS_PER_SECOND = 5
+
+# a semaphore gets bound to the event loop it is first awaited in, hence one semaphore per loop
+_LLM_SEMAPHORES: WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = WeakKeyDictionary()
+_SERPAPI_SEMAPHORES: WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = WeakKeyDictionary()
+
+
+def get_llm_semaphore() -> asyncio.Semaphore:
+    """
+    Get the semaphore that limits the number of concurrent LLM requests in the running event loop.
+    """
+    return _get_loop_semaphore(_LLM_SEMAPHORES, LLM_CONCURRENCY_LIMIT)
+
+
+def get_serpapi_semaphore() -> asyncio.Semaphore:
+    """
+    Get the semaphore that limits the number of concurrent SerpAPI requests in the running event loop.
+    """
+    return _get_loop_semaphore(_SERPAPI_SEMAPHORES, SERPAPI_CONCURRENCY_LIMIT)
+
+
+def _get_loop_semaphore(
+    semaphores: WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore], limit: int
+) -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(limit)
+        semaphores[loop] = semaphore
+    return semaphore
+
+
+class RequestRateLimiter:
+    """
+    Spaces out requests to an external service, so no more than max_requests_per_second of them are started (and the
+    service doesn't start responding with "429 Too Many Requests").
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, max_requests_per_second: float) -> None:
+        self._interval = 1 / max_requests_per_second
+        self._next_request_time = 0.0
+
+    async def aacquire(self) -> None:
+        """
+        Wait until the next request is allowed to be started.
+        """
+        now = time.monotonic()
+        delay = self._next_request_time - now
+        # the slot is reserved before sleeping, so the concurrent callers line up one interval apart from each other
+        self._next_request_time = max(self._next_request_time, now) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+SERPAPI_RATE_LIMITER = RequestRateLimiter(SERPAPI_REQUESTS_PER_SECOND)
+# OpenAI rate limits are per model, hence one limiter per model
+LLM_RATE_LIMITERS: defaultdict[str, RequestRateLimiter] = defaultdict(
+    partial(RequestRateLimiter, LLM_REQUESTS_PER_SECOND)
+)
 
 forum = Forum()
 
 MOCK_CALLS = False
 CAPTURE_MOCKING_DATA = False
+# responses that come from the store are neither mocked nor captured, hence the store is off in those modes
+CACHE_LLM_RESPONSES = not (MOCK_CALLS or CAPTURE_MOCKING_DATA)
+CACHE_SERPAPI_RESULTS = not (MOCK_CALLS or CAPTURE_MOCKING_DATA)
+SERPAPI_RESULTS_TTL = 7 * 24 * 60 * 60  # search results do change over time, unlike LLM responses to a fixed prompt
 
 CAPTURED_DATA = {
     "openai": [],
@@ -81,3 +166,39 @@ slow_gpt_completion = partial(
     zero_temperature_completion,
     model=SLOW_GPT,
 )
+
+
+async def amaterialize_completion(completion_fn: Callable[..., Any], **kwargs) -> str:
+    """
+    Run a chat completion and return its content. If CACHE_LLM_RESPONSES is on then responses to zero temperature
+    requests are looked up in (and written through to) the persistent response store first.
+    """
+    # everything in this project is zero temperature unless explicitly overridden
+    key_kwargs = {"model": completion_fn.keywords.get("model"), "temperature": 0, **kwargs}
+    if not CACHE_LLM_RESPONSES or key_kwargs["temperature"] != 0:
+        # non-zero temperature responses are not reproducible, so there is no point in storing them
+        return await _arequest_completion(completion_fn, **kwargs)
+
+    prompt_sha256 = await acalculate_prompt_sha256(**key_kwargs)
+    response = await arun_in_store_thread(get_response, prompt_sha256)
+    if response is None:
+        response = await _arequest_completion(completion_fn, **kwargs)
+        await arun_in_store_thread(put_response, prompt_sha256, response, model=key_kwargs["model"])
+    return response
+
+
+async def _arequest_completion(completion_fn: Callable[..., Any], **kwargs) -> str:
+    """
+    Run a chat completion within the LLM concurrency and rate limits and return its content. Rate limit errors are
+    retried with jittered exponential back-off instead of hammering the API even more.
+    """
+    rate_limiter = LLM_RATE_LIMITERS[kwargs.get("model", completion_fn.keywords.get("model"))]
+    async with get_llm_semaphore():
+        for attempt in range(MAX_RATE_LIMIT_RETRIES):
+            await rate_limiter.aacquire()
+            try:
+                return await completion_fn(**kwargs).amaterialize_content()
+            except openai.RateLimitError:
+                await asyncio.sleep(random.uniform(0.5, 1.5) * 2**attempt)
+        await rate_limiter.aacquire()
+        return await completion_fn(**kwargs).amaterialize_content()
@@ -15,12 +15,60 @@ from forum_versus_gaia.forum_versus_gaia_config import (
     forum,
     slow_gpt_completion,
     fast_gpt_completion,
+    amaterialize_completion,
     CAPTURE_MOCKING_DATA,
 )
 from forum_versus_gaia.more_agents.pdf_finder_agent import pdf_finder_agent
 
 MAX_NUM_OF_RESEARCHES = 2
 
+# the prompt messages that never change are built only once
+GAIA_SYSTEM_MSG = {
+    "content": (
+        "You are a general AI assistant. I will ask you a question. Report your thoughts, and finish "
+        "your answer with the following template: FINAL ANSWER: [YOUR FINAL ANSWER].\n"
+        "YOUR FINAL ANSWER should be a number OR as few words as possible OR a comma separated list "
+        "of numbers and/or strings.\n"
+        "If you are asked for a number, don’t use comma to write your number neither use units such "
+        "as $ or percent sign unless specified otherwise.\n"
+        "If you are asked for a string, don’t use articles, neither abbreviations (e.g. for cities), "
+        "and write the digits in plain text unless specified otherwise.\n"
+        "If you are asked for a comma separated list, apply the above rules depending of whether the "
+        "element to be put in the list is a number or a string."
+    ),
+    "role": "system",
+}
+ANSWER_CONTEXT_INTRO_MSG = {
+    "content": "In order to answer the question use the following info:",
+    "role": "system",
+}
+QUESTION_INTRO_MSG = {
+    "content": "HERE GOES THE QUESTION:",
+    "role": "system",
+}
+JUDGE_QUESTION_INTRO_MSG = {
+    "content": "Your job is to judge whether the user's question was answered or not. Here is the user's question:",
+    "role": "system",
+}
+JUDGE_ANSWER_INTRO_MSG = {
+    "content": "And here is the answer:",
+    "role": "system",
+}
+JUDGE_OPTIONS_MSG = {
+    "content": (
+        "Choose a single option that best describes what happened:\n"
+        "\n"
+        "1. The question was answered.\n"
+        "2. There was not enough information in the context to answer the question.\n"
+        "3. None of the above.\n"
+        "\n"
+        "Answer with a single number and no other text.\n"
+        "\n"
+        "ANSWER:"
+    ),
+    "role": "system",
+}
+
 
 @forum.agent
 async def gaia_agent(ctx: InteractionContext, **kwargs) -> None:
@@ -55,71 +103,29 @@ async def gaia_agent(ctx: InteractionContext, **kwargs) -> None:
         #  after the concept of @forum.user_agent is introduced
 
         prompt = [
-            {
-                "content": (
-                    "You are a general AI assistant. I will ask you a question. Report your thoughts, and finish "
-                    "your answer with the following template: FINAL ANSWER: [YOUR FINAL ANSWER].\n"
-                    "YOUR FINAL ANSWER should be a number OR as few words as possible OR a comma separated list "
-                    "of numbers and/or strings.\n"
-                    "If you are asked for a number, don’t use comma to write your number neither use units such "
-                    "as $ or percent sign unless specified otherwise.\n"
-                    "If you are asked for a string, don’t use articles, neither abbreviations (e.g. for cities), "
-                    "and write the digits in plain text unless specified otherwise.\n"
-                    "If you are asked for a comma separated list, apply the above rules depending of whether the "
-                    "element to be put in the list is a number or a string."
-                ),
-                "role": "system",
-            },
-            {
-                "content": "In order to answer the question use the following info:",
-                "role": "system",
-            },
+            GAIA_SYSTEM_MSG,
+            ANSWER_CONTEXT_INTRO_MSG,
             accumulated_context,
-            {
-                "content": "HERE GOES THE QUESTION:",
-                "role": "system",
-            },
+            QUESTION_INTRO_MSG,
             ctx.request_messages,
         ]
         answer_msg = slow_gpt_completion(prompt=prompt, pl_tags=["FINISH"], **kwargs)
         ctx.respond(answer_msg)
 
         prompt = [
-            {
-                "content": (
-                    "Your job is to judge whether the user's question was answered or not. Here is the user's "
-                    "question:"
-                ),
-                "role": "system",
-            },
+            JUDGE_QUESTION_INTRO_MSG,
             ctx.request_messages,
-            {
-                "content": "And here is the answer:",
-                "role": "system",
-            },
+            JUDGE_ANSWER_INTRO_MSG,
             {
                 "content": await answer_msg.amaterialize_content(),
                 "role": "assistant",
             },
-            {
-                "content": (
-                    "Choose a single option that best describes what happened:\n"
-                    "\n"
-                    "1. The question was answered.\n"
-                    "2. There was not enough information in the context to answer the question.\n"
-                    "3. None of the above.\n"
-                    "\n"
-                    "Answer with a single number and no other text.\n"
-                    "\n"
-                    "ANSWER:"
-                ),
-                "role": "system",
-            },
+            JUDGE_OPTIONS_MSG,
         ]
         if research_idx < MAX_NUM_OF_RESEARCHES - 1:
             # this is not the last attempt at research yet
-            is_answered_msg = fast_gpt_completion(prompt=prompt, pl_tags=["CHECK_ANSWER"])
-            for char in await is_answered_msg.amaterialize_content():
+            is_answered = await amaterialize_completion(fast_gpt_completion, prompt=prompt, pl_tags=["CHECK_ANSWER"])
+            for char in is_answered:
                 if char.isdigit():
                     if char == "1":
                         return  # the question was answered
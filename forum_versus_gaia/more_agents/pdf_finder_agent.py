@@ -2,32 +2,107 @@
 This module contains an agent that finds PDF documents on the internet.
 """
 
+import asyncio
 import json
+import re
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Any, NamedTuple, Optional
 
-from agentforum.ext.llms.openai import anum_tokens_from_messages
+import openai
+import tiktoken
 from agentforum.forum import InteractionContext, USER_ALIAS
 from agentforum.models import Message
 from agentforum.utils import arender_conversation
 
-from forum_versus_gaia.forum_versus_gaia_config import forum, slow_gpt_completion
+from forum_versus_gaia.forum_versus_gaia_config import (
+    forum,
+    slow_gpt_completion,
+    fast_gpt_completion,
+    amaterialize_completion,
+    SLOW_GPT,
+)
 from forum_versus_gaia.utils import (
-    get_serpapi_results,
+    aget_serpapi_results,
     convert_html_to_markdown,
     ContentMismatchError,
     assert_valid_url,
+    is_valid_url,
     ContentNotFoundError,
-    ForumVersusGaiaError,
     TooManyStepsError,
     adownload_from_web,
     ContentAlreadySeenError,
+    normalize_url,
+    prefetch_from_web,
+    is_pdf_url,
+    afind_pdf_url,
+    ForumVersusGaiaError,
 )
 
 MAX_RETRIES = 3
 MAX_DEPTH = 7
+PREFETCHED_SEARCH_RESULTS = 3
+PDF_SHORTCUT_SEARCH_RESULTS = 3
+PDF_PROBE_TIMEOUT = 5  # seconds - a slow host among the top results should not hold the whole search back
+
+WEB_PAGE_PROMPT_HEADER_TEMPLATE = (
+    "Your name is {AGENT_ALIAS}. You will be provided with the content of a web page that was found via web search "
+    "with a given user query. The user is looking for a PDF document. Your job is to extract from this web page a "
+    "URL that, in your opinion, is the most likely to lead to the PDF document the user is looking for."
+)
+SERPAPI_PROMPT_HEADER_TEMPLATE = (
+    "Your name is {AGENT_ALIAS}. You will be provided with a SerpAPI JSON response that contains a list of search "
+    "results for a given user query. The user is looking for a PDF document. Your job is to extract a URL that, in "
+    "your opinion, is the most likely to contain the PDF document the user is looking for."
+)
 
+JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+# the prompt messages that never change are built only once
+SEARCH_QUERY_FORMAT_MSG = {
+    "content": (
+        "Use the following format:\n"
+        "\n"
+        "Thought: you should always think out loud before you come up with a search query\n"
+        "Search Query: the query to use to search for the PDF document\n"
+        "\n"
+        'If you need to search for multiple PDF documents then just repeat "Search Query:" multiple times.\n'
+        "\n"
+        "NOTE #1: You are using a special search engine that already knows that you're looking for PDFs, so "
+        'you shouldn\'t include "PDF" or "filetype:pdf" or anything like that in your query.\n'
+        "NOTE #2: Do not try to search for any specific information that might be contained in the PDF, "
+        "just search for the PDF itself.\n"
+        "\n"
+        "Begin!\n"
+        "\n"
+        "Thought:"
+    ),
+    "role": "system",
+}
+URL_JSON_FORMAT_MSG = {
+    "content": 'PLEASE ONLY RETURN A JSON OBJECT OF THE FORM {"url": "<the url>"} AND NO OTHER TEXT.',
+    "role": "system",
+}
+
+WEB_PAGE_MAX_TOKENS = 6000
 PDF_MAX_TOKENS = 100000
 PDF_CHAR_WINDOW = 10000
-PDF_CHAR_OVERLAP = 1000
+# the model can take a whole chunk of this size at once, so a big PDF is split into as few chunks as possible
+PDF_CHUNK_TOKENS = PDF_MAX_TOKENS
+PDF_CHUNK_OVERLAP_TOKENS = 1000
+
+
+class SharedResearch(NamedTuple):
+    """
+    The urls and pdfs that were already tried by any of the queries that pdf_finder_agent researches concurrently.
+    """
+
+    tried_urls: set[str]
+    checked_pdfs: set[str]
+
+
+# the browsing agents run in tasks that are children of pdf_finder_agent's task, so they all inherit the value it sets
+_SHARED_RESEARCH: ContextVar[Optional[SharedResearch]] = ContextVar("_SHARED_RESEARCH", default=None)
 
 
 @forum.agent
@@ -49,51 +124,40 @@ async def pdf_finder_agent(ctx: InteractionContext) -> None:
             "content": await arender_conversation(ctx.request_messages),
             "role": "user",
         },
-        {
-            "content": (
-                "Use the following format:\n"
-                "\n"
-                "Thought: you should always think out loud before you come up with a search query\n"
-                "Search Query: the query to use to search for the PDF document\n"
-                "\n"
-                'If you need to search for multiple PDF documents then just repeat "Search Query:" multiple times.\n'
-                "\n"
-                "NOTE #1: You are using a special search engine that already knows that you're looking for PDFs, so "
-                'you shouldn\'t include "PDF" or "filetype:pdf" or anything like that in your query.\n'
-                "NOTE #2: Do not try to search for any specific information that might be contained in the PDF, "
-                "just search for the PDF itself.\n"
-                "\n"
-                "Begin!\n"
-                "\n"
-                "Thought:"
-            ),
-            "role": "system",
-        },
+        SEARCH_QUERY_FORMAT_MSG,
     ]
-    queries = await slow_gpt_completion(prompt=prompt, pl_tags=["START"]).amaterialize_content()
+    queries_str = await amaterialize_completion(slow_gpt_completion, prompt=prompt, pl_tags=["START"])
+    queries = [query.split("\n\n")[0].strip() for query in queries_str.split("Search Query:")[1:]]
 
-    responses = None
-    for query in queries.split("Search Query:")[1:]:
-        query = query.split("\n\n")[0].strip()
-
-        for _ in range(MAX_RETRIES):
-            responses = pdf_browsing_agent.ask(query, branch_from=responses)
-            if not await responses.acontains_errors():
-                break
+    # the queries are researched concurrently, but they still don't try the same urls or read the same pdfs twice (the
+    # way they wouldn't if each query continued the branch of the previous one)
+    _SHARED_RESEARCH.set(SharedResearch(tried_urls=set(), checked_pdfs=set()))
+    all_responses = await asyncio.gather(*[_aresearch_query(query) for query in queries])
 
+    for responses in all_responses:
         # TODO TODO TODO TODO TODO Oleksandr: two problems with this workaround:
         #  1. if there are no responses at all, we loose the history of what urls and pdfs were tried in this branch
         #     (or branches)
         #  2. too much boilerplate code (or something else ? I already forgot what problem I was going to write down)
-        responses_as_list = [resp async for resp in responses]
-        if responses_as_list:
-            branch_further_response_from = await responses_as_list[0].aget_previous_msg_promise()
-        else:
-            branch_further_response_from = None
+        branch_further_response_from = None
+        async for first_response in responses:
+            # we only need the first response, no need to wait for the rest of them
+            branch_further_response_from = await first_response.aget_previous_msg_promise()
+            break
 
         ctx.respond(responses, branch_from=branch_further_response_from)
 
 
+async def _aresearch_query(query: str):
+    # retries happen in the same branch, so the browsing agent knows which urls and pdfs were already tried
+    responses = None
+    for _ in range(MAX_RETRIES):
+        responses = pdf_browsing_agent.ask(query, branch_from=responses)
+        if not await responses.acontains_errors():
+            break
+    return responses
+
+
 @forum.agent(alias="BROWSING_AGENT")
 async def pdf_browsing_agent(ctx: InteractionContext, depth: int = MAX_DEPTH) -> None:
     """
@@ -102,73 +166,139 @@ async def pdf_browsing_agent(ctx: InteractionContext, depth: int = MAX_DEPTH) ->
     if depth <= 0:
         raise TooManyStepsError("I couldn't find a PDF document within a reasonable number of steps.")
 
-    request = await ctx.request_messages.amaterialize_concluding_message()
-    already_tried_urls = await acollect_tried_urls(ctx)
+    # the history is walked by several helpers below, but it is materialized only once (the request itself is the
+    # last message of the history, so it doesn't need to be materialized separately)
+    full_history = await ctx.request_messages.amaterialize_full_history()
+    request = full_history[-1]
+    already_tried_urls = collect_tried_urls(full_history) | get_shared_research().tried_urls
+    # normalized only once - membership is checked against this set for every search result
+    normalized_tried_urls = {normalize_url(url) for url in already_tried_urls}
+    # rendered only once per invocation - all the prompts below need the same user utterances
+    user_utterances = await render_user_utterances(full_history)
 
     if hasattr(request, "page_url"):
         web_content, is_pdf = await adownload_from_web(request.page_url)
 
         if is_pdf:
-            # pdf was found! returning its text
-            # TODO Oleksandr: introduce the concept of user_proxy_agent to send all these service messages
-            #  to that agent instead of just printing them directly to the console
-            print(f"\n\033[90m📗 READING PDF FROM: {request.page_url}", end="", flush=True)
-
-            already_checked_pdfs = await acollect_checked_pdfs(ctx)
-            if web_content in already_checked_pdfs:
-                print(" - ALREADY SEEN\033[0m")
-                raise ContentAlreadySeenError
-
-            pdf_snippets = await aextract_pdf_snippets(
-                pdf_text=web_content, user_request=await render_user_utterances(ctx)
-            )
-            ctx.respond(pdf_snippets, pdf=web_content)
+            await aread_pdf(ctx, request.page_url, web_content, full_history, user_utterances)
             return
 
         print(f"\n\033[90m🔗 NAVIGATING TO: {request.page_url}\033[0m")
 
-        prompt_header_template = (
-            "Your name is {AGENT_ALIAS}. You will be provided with the content of a web page that was found via "
-            "web search with a given user query. The user is looking for a PDF document. Your job is to extract "
-            "from this web page a URL that, in your opinion, is the most likely to lead to the PDF document the "
-            "user is looking for."
-        )
-        prompt_context = convert_html_to_markdown(web_content, baseurl=request.page_url)
+        prompt_header_template = WEB_PAGE_PROMPT_HEADER_TEMPLATE
+        # html parsing is CPU-bound, so it is moved off the event loop to not block the other agents
+        prompt_context = await asyncio.to_thread(convert_html_to_markdown, web_content, baseurl=request.page_url)
         prompt_context = remove_tried_urls_in_markdown(prompt_context, already_tried_urls)
+        # the links that matter are rarely at the very bottom of a page, while a huge page could even exceed the
+        # context window of the model
+        prompt_context = await asyncio.to_thread(truncate_to_tokens, prompt_context, max_tokens=WEB_PAGE_MAX_TOKENS)
 
     else:
         print(f"\n\033[90m🔍 LOOKING FOR PDF: {request.content}\033[0m")
 
-        organic_results = get_serpapi_results(request.content)
-        organic_results = [result for result in organic_results if result["link"].strip() not in already_tried_urls]
+        organic_results = [
+            result
+            for result in await aget_serpapi_results(request.content)
+            if normalize_url(result["link"]) not in normalized_tried_urls
+        ]
+        page_url = find_pdf_search_result(organic_results[:PDF_SHORTCUT_SEARCH_RESULTS])
+        if not page_url:
+            # GPT most often picks one of the top results, so those are downloaded while the decision is being made
+            # (the shortcut above would make these downloads wasted, hence they are only started once it didn't work
+            # out)
+            prefetch_from_web(result["link"].strip() for result in organic_results[:PREFETCHED_SEARCH_RESULTS])
+            page_url = await afind_pdf_search_result(organic_results[:PDF_SHORTCUT_SEARCH_RESULTS])
+        if page_url:
+            # one of the top search results is a PDF itself - no need to ask GPT which url to pick (if it is the wrong
+            # PDF, the next step will find that out)
+            navigate_to_url(page_url, depth=depth - 1)
+            return
 
-        prompt_header_template = (
-            "Your name is {AGENT_ALIAS}. You will be provided with a SerpAPI JSON response that contains a list "
-            "of search results for a given user query. The user is looking for a PDF document. Your job is to "
-            "extract a URL that, in your opinion, is the most likely to contain the PDF document the user is "
-            "looking for."
-        )
-        prompt_context = json.dumps(organic_results)
+        # only the fields that help to choose a url are kept - the rest (sitelinks, favicons etc.) is just noise that
+        # inflates the prompt
+        organic_results = [
+            {"title": result.get("title"), "link": result["link"], "snippet": result.get("snippet")}
+            for result in organic_results
+        ]
+
+        prompt_header_template = SERPAPI_PROMPT_HEADER_TEMPLATE
+        # compact separators and no \uXXXX escapes - no point in paying for whitespace tokens or for non-ascii titles
+        # and snippets that are several times longer than they need to be
+        prompt_context = json.dumps(organic_results, separators=(",", ":"), ensure_ascii=False)
 
     page_url = await ask_gpt_for_url(
         ctx=ctx,
+        user_utterances=user_utterances,
         prompt_header_template=prompt_header_template,
         prompt_context=prompt_context,
         pl_tags=[f"d{depth}"],
     )
-
     assert_valid_url(page_url, error_class=ContentNotFoundError)
+    if normalize_url(page_url) in normalized_tried_urls:
+        # GPT sometimes picks an already tried url anyway (it may see it mentioned elsewhere) - no point in going one
+        # level deeper just to find that out there
+        raise ContentAlreadySeenError("This URL was already tried.", page_url=page_url)
+    navigate_to_url(page_url, depth=depth - 1)
+
+
+def navigate_to_url(page_url: str, depth: int) -> None:
+    """
+    Make the browsing agent go to the given URL (the URL is remembered as tried by all the concurrent queries).
+    """
+    get_shared_research().tried_urls.add(page_url)
     pdf_browsing_agent.tell(
         Message(
             content_template="{page_url}",
             page_url=page_url,
         ),
-        depth=depth - 1,
+        depth=depth,
+    )
+
+
+async def afind_pdf_search_result(organic_results: list[dict[str, Any]]) -> Optional[str]:
+    """
+    Probe the links of the given SerpAPI organic results over HTTP (not every PDF link ends with .pdf) and return the
+    first one that leads to a PDF document. None is returned if there is no such link or if probing takes longer than
+    PDF_PROBE_TIMEOUT. The probe is awaited before GPT is asked to pick a url, because cancelling a completion that
+    was already requested would not save its cost.
+    """
+    try:
+        return await asyncio.wait_for(
+            afind_pdf_url(result["link"].strip() for result in organic_results), timeout=PDF_PROBE_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        return None
+
+
+async def aread_pdf(
+    ctx: InteractionContext, page_url: str, pdf_text: str, full_history: list[Message], user_utterances: str
+) -> None:
+    """
+    Respond with the snippets of a found PDF document that are relevant to the user's request (unless the same PDF was
+    already read).
+    """
+    # pdf was found! returning its text
+    # TODO Oleksandr: introduce the concept of user_proxy_agent to send all these service messages
+    #  to that agent instead of just printing them directly to the console
+    print(f"\n\033[90m📗 READING PDF FROM: {page_url}", end="", flush=True)
+
+    checked_pdfs = get_shared_research().checked_pdfs
+    if pdf_text in checked_pdfs or pdf_text in collect_checked_pdfs(full_history):
+        print(" - ALREADY SEEN\033[0m")
+        raise ContentAlreadySeenError
+    # marked right away (there is no await in between) - a concurrent query that downloads the same pdf will see it as
+    # already seen instead of reading it again
+    checked_pdfs.add(pdf_text)
+
+    ctx.respond(
+        await aextract_pdf_snippets(pdf_text=pdf_text, user_request=user_utterances),
+        pdf=pdf_text,
     )
 
 
 async def ask_gpt_for_url(
     ctx: InteractionContext,
+    user_utterances: str,
     prompt_header_template: str,
     prompt_context: str,
     pl_tags: list[str] = (),
@@ -178,83 +308,104 @@ async def ask_gpt_for_url(
     """
     prompt = [
         {
-            "content": prompt_header_template.format(AGENT_ALIAS=ctx.this_agent.alias),
+            "content": format_prompt_header(prompt_header_template, ctx.this_agent.alias),
             "role": "system",
         },
         {
-            "content": await render_user_utterances(ctx),
+            "content": user_utterances,
             "role": "user",
         },
         {
             "content": prompt_context,
             "role": "user",
         },
-        {
-            "content": "PLEASE ONLY RETURN A URL AND NO OTHER TEXT.\n\nURL:",
-            # "content": (
-            #     "Use the following format:\n"
-            #     "\n"
-            #     "Thought: you should always think out loud before choose a url\n"
-            #     "URL: https://... (only the url, NO MARKDOWN)\n"
-            #     "\n"
-            #     "Begin!\n"
-            #     "\n"
-            #     "Thought:"
-            # ),
-            "role": "system",
-        },
+        URL_JSON_FORMAT_MSG,
     ]
-    completion = await slow_gpt_completion(prompt=prompt, pl_tags=pl_tags).amaterialize_content()
-    page_url = completion.strip()
-    # parts = completion.split("URL:")
-    # if len(parts) < 2:
-    #     return completion  # there is no url, just some text (probably an error message) -> return the whole thing
-    # page_url = parts[1].split("\n\n")[0].strip()
+    # picking a url is simple enough for the fast model - the slow one is only asked if the fast one fails (with an
+    # error or by not coming up with a valid url)
+    try:
+        completion = await amaterialize_completion(
+            fast_gpt_completion, prompt=prompt, pl_tags=pl_tags, response_format=JSON_RESPONSE_FORMAT
+        )
+    except (openai.BadRequestError, ForumVersusGaiaError):
+        # the prompt exceeding the (much smaller) context window of the fast model, for example
+        page_url = None
+    else:
+        page_url = parse_url_json(completion)
+    if page_url is None or not is_valid_url(page_url):
+        completion = await amaterialize_completion(
+            slow_gpt_completion, prompt=prompt, pl_tags=pl_tags, response_format=JSON_RESPONSE_FORMAT
+        )
+        # if there is no url, the whole completion is returned (it is probably an explanation of why there is none)
+        page_url = parse_url_json(completion) or completion.strip()
     return page_url
 
 
-async def acollect_tried_urls(ctx: InteractionContext) -> set[str]:
+def parse_url_json(completion: str) -> Optional[str]:
+    """
+    Parse a URL out of a JSON completion of the form {"url": "..."}. Returns None if the completion is not like that.
+    """
+    try:
+        page_url = json.loads(completion)["url"]
+    except (ValueError, TypeError, KeyError):
+        return None
+    return page_url.strip() if isinstance(page_url, str) else None
+
+
+def find_pdf_search_result(organic_results: list[dict[str, Any]]) -> Optional[str]:
+    """
+    Returns the link of the first SerpAPI organic result that is a PDF document or None if there is no such result.
+    SerpAPI marks PDFs with file_format, but the link itself is checked too, because the marker is not always there.
+    """
+    for result in organic_results:
+        if result.get("file_format") == "PDF" or is_pdf_url(result["link"]):
+            return result["link"].strip()
+    return None
+
+
+@lru_cache
+def format_prompt_header(prompt_header_template: str, agent_alias: str) -> str:
+    """
+    Format a prompt header for a given agent (the result never changes for the same template and alias).
+    """
+    return prompt_header_template.format(AGENT_ALIAS=agent_alias)
+
+
+def get_shared_research() -> SharedResearch:
+    """
+    Get the urls and pdfs tried by the concurrent queries of the current pdf_finder_agent call. If the browsing agent
+    was not called by pdf_finder_agent, then nothing is shared, and an empty SharedResearch is returned.
+    """
+    return _SHARED_RESEARCH.get() or SharedResearch(tried_urls=set(), checked_pdfs=set())
+
+
+def collect_tried_urls(full_history: list[Message]) -> set[str]:
     """
     Collect URLs that were already tried by the agent.
     """
-    tried_urls = {
-        msg.page_url for msg in await ctx.request_messages.amaterialize_full_history() if hasattr(msg, "page_url")
-    }
-    # # try:
-    # #     tried_urls.remove("https://www.nsi.bg/census2011/PDOCS2/Census2011final_en.pdf")
-    # # except KeyError:
-    # #     pass
-    # # tried_urls.add("https://muse.jhu.edu/book/24372")
-    # print()
-    # print()
-    # print()
-    # print()
-    # for msg in await ctx.request_messages.amaterialize_full_history():
-    #     print(f"{msg.original_sender_alias}: {msg.content[:1000]}")
-    #     print()
-    # # print()
-    # # print()
-    # # print()
-    # # pprint(tried_urls)
-    # print()
-    # print()
-    return tried_urls
-
-
-async def acollect_checked_pdfs(ctx: InteractionContext) -> set[str]:
+    return {msg.page_url for msg in full_history if hasattr(msg, "page_url")}
+
+
+def collect_checked_pdfs(full_history: list[Message]) -> set[str]:
     """
     Collect pdf texts that were already seen by the model.
     """
-    return {msg.pdf for msg in await ctx.request_messages.amaterialize_full_history() if hasattr(msg, "pdf")}
+    return {msg.pdf for msg in full_history if hasattr(msg, "pdf")}
 
 
 def remove_tried_urls_in_markdown(prompt_context: str, tried_urls: set[str]) -> str:
     """
     Remove URLs that were already tried from the prompt_context.
     """
-    for url in tried_urls:
-        prompt_context = prompt_context.replace(f"({url})", "(#)")
-    return prompt_context
+    if not tried_urls:
+        return prompt_context
+    # one pass over the (potentially huge) markdown instead of one pass per url
+    return _compile_tried_urls_pattern(frozenset(tried_urls)).sub("(#)", prompt_context)
+
+
+@lru_cache(maxsize=128)
+def _compile_tried_urls_pattern(tried_urls: frozenset[str]) -> re.Pattern[str]:
+    return re.compile("|".join(re.escape(f"({url})") for url in tried_urls))
 
 
 async def aextract_pdf_snippets(pdf_text: str, user_request: str) -> str:
@@ -272,32 +423,26 @@ async def aextract_pdf_snippets(pdf_text: str, user_request: str) -> str:
             "role": "user",
         },
     ]
-    pdf_token_num = await anum_tokens_from_messages(pdf_msgs)
-    print(f" - {pdf_token_num} tokens\033[0m")
-
-    if pdf_token_num > PDF_MAX_TOKENS:
-        return await apartition_pdf_and_extract_snippets(pdf_text=pdf_text, user_request=user_request)
-
-    answer = await slow_gpt_completion(
+    if len(pdf_text.encode()) <= PDF_MAX_TOKENS:
+        # every token covers at least one UTF-8 byte, so a text this short fits without being tokenized
+        print(f" - {len(pdf_text)} characters\033[0m")
+    else:
+        # characters per token vary too much between languages (and between text and numbers) for any estimate to
+        # be safe, hence the exact count (which stops as soon as the limit is exceeded)
+        pdf_token_num = await asyncio.to_thread(count_pdf_tokens, pdf_text, max_tokens=PDF_MAX_TOKENS)
+        if pdf_token_num > PDF_MAX_TOKENS:
+            print(f" - more than {PDF_MAX_TOKENS} tokens\033[0m")
+            return await apartition_pdf_and_extract_snippets(pdf_text=pdf_text, user_request=user_request)
+        print(f" - {pdf_token_num} tokens\033[0m")
+
+    answer = await amaterialize_completion(
+        slow_gpt_completion,
         prompt=[
             {
                 "content": (
                     "You are an AI assistant and you are good at extracting relevant information from PDF documents. "
-                    "Below is a PDF document."
-                ),
-                "role": "system",
-            },
-            *pdf_msgs,
-            {
-                "content": "And here is what the user asked for.",
-                "role": "system",
-            },
-            {
-                "content": user_request,
-                "role": "user",
-            },
-            {
-                "content": (
+                    "You will be given the user's request and a PDF document.\n"
+                    "\n"
                     "Please extract a snippet or snippets from the PDF document that you think are relevant to the "
                     "user's request. Use the following format:\n"
                     "\n"
@@ -311,66 +456,244 @@ async def aextract_pdf_snippets(pdf_text: str, user_request: str) -> str:
                     "\n"
                     'ATTENTION! DO NOT ANSWER WITH "MISMATCH" IF YOU WERE ABLE TO FIND EVEN A TINY BIT OF RELEVANT '
                     'INFORMATION. "MISMATCH" is ONLY for cases when there was NOT EVEN A SINGLE PIECE of relevant '
-                    "information (ABSOLUTE ZERO)!\n"
-                    "\n"
-                    "Begin!"
+                    "information (ABSOLUTE ZERO)!"
                 ),
                 "role": "system",
             },
+            {
+                "content": "Here is what the user asked for.",
+                "role": "system",
+            },
+            {
+                "content": user_request,
+                "role": "user",
+            },
+            {
+                "content": "And here is the PDF document.",
+                "role": "system",
+            },
+            *pdf_msgs,
+            {
+                "content": "Begin!",
+                "role": "system",
+            },
         ],
         pl_tags=["READ_PDF"],
-    ).amaterialize_content()
+    )
     answer = answer.strip()
     if answer.upper() == "MISMATCH":
         raise ContentMismatchError("This PDF document does not contain any relevant information.", pdf=pdf_text)
     return answer
 
 
+@lru_cache
+def get_slow_gpt_encoding() -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding of SLOW_GPT (resolved only once).
+    """
+    return tiktoken.encoding_for_model(SLOW_GPT)
+
+
+def count_pdf_tokens(pdf_text: str, max_tokens: int) -> int:
+    """
+    Count the tokens of a PDF text window by window. Counting stops as soon as max_tokens is exceeded (the exact
+    number of tokens beyond that point doesn't matter), so the rest of a big document is never tokenized.
+    """
+    encoding = get_slow_gpt_encoding()
+    token_num = 0
+    for i in range(0, len(pdf_text), PDF_CHAR_WINDOW):
+        token_num += len(encoding.encode_ordinary(pdf_text[i : i + PDF_CHAR_WINDOW]))
+        if token_num > max_tokens:
+            break
+    return token_num
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cut a text down to max_tokens tokens. The text is tokenized window by window and only up to the point where
+    max_tokens is exceeded, so the rest of a big text is never tokenized.
+    """
+    if len(text.encode()) <= max_tokens:
+        return text  # every token covers at least one UTF-8 byte
+    encoding = get_slow_gpt_encoding()
+    tokens = []
+    for i in range(0, len(text), PDF_CHAR_WINDOW):
+        tokens.extend(encoding.encode_ordinary(text[i : i + PDF_CHAR_WINDOW]))
+        if len(tokens) > max_tokens:
+            return encoding.decode(tokens[:max_tokens])
+    return text
+
+
 async def apartition_pdf_and_extract_snippets(pdf_text: str, user_request: str) -> str:
     """
     Partition a PDF document into chunks and extract snippets from each chunk that are relevant to the user's request.
     If pdf_text is a wrong PDF document or does not contain any useful information then ContentMismatchError is
     raised.
     """
-    raise ForumVersusGaiaError("PDF partitioning is not implemented yet", pdf=pdf_text)
-    # pylint: disable=unreachable
-    pdf_metadata = await agenerate_metadata_from_pdf_parts(pdf_text=pdf_text, user_request=user_request)
-    # TODO TODO TODO Oleksandr
-    return pdf_metadata
+    chunks = await asyncio.to_thread(split_pdf_text_into_chunks, pdf_text)
+    # all the chunks are independent from each other, so they are processed concurrently
+    tasks = [
+        asyncio.create_task(agenerate_metadata_from_pdf_parts(pdf_text=pdf_text, user_request=user_request)),
+        *[
+            asyncio.create_task(aextract_pdf_chunk_snippets(pdf_chunk=chunk, user_request=user_request))
+            for chunk in chunks
+        ],
+    ]
+    try:
+        pdf_metadata, *chunk_snippets = await asyncio.gather(*tasks)
+    except BaseException:
+        # gather leaves the other tasks running when one of them fails, but nobody needs their results anymore (not
+        # asyncio.TaskGroup, because the original error is reported, not an ExceptionGroup)
+        for task in tasks:
+            task.cancel()
+        raise
+    chunk_snippets = [snippets for snippets in chunk_snippets if snippets.upper() != "MISMATCH"]
+    if not chunk_snippets:
+        raise ContentMismatchError("This PDF document does not contain any relevant information.", pdf=pdf_text)
 
+    chunk_snippets_str = "\n\n".join(chunk_snippets)
+    pdf_snippets = f"{pdf_metadata}\nRELEVANT SNIPPET(S):\n{chunk_snippets_str}"
+    if len(chunk_snippets) == 1:
+        return pdf_snippets
+    return await amerge_pdf_snippets(pdf_snippets=pdf_snippets, user_request=user_request)
 
-async def agenerate_metadata_from_pdf_parts(pdf_text: str, user_request: str) -> str:
+
+def split_pdf_text_into_chunks(pdf_text: str) -> list[str]:
     """
-    Generate metadata for a PDF document from its parts (beginning, middle and end). If pdf_text is a wrong PDF
-    document or does not contain any useful information then ContentMismatchError is raised.
+    Split a PDF text into overlapping chunks of PDF_CHUNK_TOKENS tokens. A chunk boundary may cut a word (or even a
+    multibyte character) in half, but thanks to the overlap the text around every boundary is seen whole in one of the
+    neighbouring chunks.
     """
-    pdf_beginning = pdf_text[:PDF_CHAR_WINDOW]
-    pdf_middle = pdf_text[len(pdf_text) // 2 - PDF_CHAR_WINDOW // 2 : len(pdf_text) // 2 + PDF_CHAR_WINDOW // 2]
-    pdf_end = pdf_text[-PDF_CHAR_WINDOW:]
+    encoding = get_slow_gpt_encoding()
+    tokens = encoding.encode_ordinary(pdf_text)
+    return [
+        encoding.decode(tokens[i : i + PDF_CHUNK_TOKENS])
+        for i in range(0, len(tokens), PDF_CHUNK_TOKENS - PDF_CHUNK_OVERLAP_TOKENS)
+    ]
+
 
-    answer = await slow_gpt_completion(
+async def amerge_pdf_snippets(pdf_snippets: str, user_request: str) -> str:
+    """
+    Merge snippets that were extracted from different chunks of a PDF document into one coherent answer (neighbouring
+    chunks overlap, so the snippets may repeat each other).
+    """
+    # the snippets of many chunks together may be long, hence the model with the bigger context window and a bound
+    pdf_snippets = await asyncio.to_thread(truncate_to_tokens, pdf_snippets, max_tokens=PDF_MAX_TOKENS)
+    answer = await amaterialize_completion(
+        slow_gpt_completion,
         prompt=[
             {
                 "content": (
-                    "You are an AI assistant and you are good at explaining what PDF documents are about. "
-                    "Below is a PDF document (some parts of it were omitted for brevity)."
+                    "You are an AI assistant and you are good at working with information extracted from PDF "
+                    "documents. You will be given the user's request, the description of a PDF document and the "
+                    "snippets that were extracted from different parts of that document.\n"
+                    "\n"
+                    "Please merge the snippets: remove the duplicates (different parts of the document overlap) and "
+                    "the snippets that turn out to be irrelevant to the user's request. Keep the relevant snippets "
+                    "verbatim. Use the following format:\n"
+                    "\n"
+                    "PDF TITLE: the title of the pdf\n"
+                    "DESCRIPTION: briefly explain what this pdf is about\n"
+                    "RELEVANT SNIPPET(S): a snippet or snippets relevant to the user's request"
                 ),
                 "role": "system",
             },
             {
-                "content": f"{pdf_beginning}...\n\n...{pdf_middle}...\n\n...{pdf_end}",
+                "content": "Here is what the user asked for.",
+                "role": "system",
+            },
+            {
+                "content": user_request,
                 "role": "user",
             },
             {
-                "content": "And here is what the user asked for.",
+                "content": "And here is the description of the PDF document and the snippets.",
+                "role": "system",
+            },
+            {
+                "content": pdf_snippets,
+                "role": "user",
+            },
+            {
+                "content": "Begin!",
+                "role": "system",
+            },
+        ],
+        pl_tags=["MERGE_PDF_SNIPPETS"],
+    )
+    return answer.strip()
+
+
+async def aextract_pdf_chunk_snippets(pdf_chunk: str, user_request: str) -> str:
+    """
+    Extract snippets from a chunk of a PDF document that are relevant to the user's request. Returns "MISMATCH" if
+    the chunk does not contain any relevant information.
+    """
+    answer = await amaterialize_completion(
+        slow_gpt_completion,
+        prompt=[
+            {
+                "content": (
+                    "You are an AI assistant and you are good at extracting relevant information from PDF documents. "
+                    "You will be given the user's request and a fragment of a PDF document.\n"
+                    "\n"
+                    "Please extract a snippet or snippets from the PDF fragment that you think are relevant to the "
+                    "user's request (make sure to capture a couple of surrounding sentences too). Respond with the "
+                    "snippet(s) only and no other text.\n"
+                    "\n"
+                    "If the PDF fragment does not contain any relevant information then respond with only one word - "
+                    "MISMATCH"
+                ),
+                "role": "system",
+            },
+            {
+                "content": "Here is what the user asked for.",
                 "role": "system",
             },
             {
                 "content": user_request,
                 "role": "user",
             },
+            {
+                "content": "And here is the PDF fragment.",
+                "role": "system",
+            },
+            {
+                "content": (
+                    f"=============== PDF FRAGMENT START ===============\n"
+                    f"{pdf_chunk}\n"
+                    f"================ PDF FRAGMENT END ================"
+                ),
+                "role": "user",
+            },
+            {
+                "content": "Begin!",
+                "role": "system",
+            },
+        ],
+        pl_tags=["READ_PDF_CHUNK"],
+    )
+    return answer.strip()
+
+
+async def agenerate_metadata_from_pdf_parts(pdf_text: str, user_request: str) -> str:
+    """
+    Generate metadata for a PDF document from its parts (beginning, middle and end). If pdf_text is a wrong PDF
+    document or does not contain any useful information then ContentMismatchError is raised.
+    """
+    pdf_beginning = pdf_text[:PDF_CHAR_WINDOW]
+    pdf_middle = pdf_text[len(pdf_text) // 2 - PDF_CHAR_WINDOW // 2 : len(pdf_text) // 2 + PDF_CHAR_WINDOW // 2]
+    pdf_end = pdf_text[-PDF_CHAR_WINDOW:]
+
+    answer = await amaterialize_completion(
+        slow_gpt_completion,
+        prompt=[
             {
                 "content": (
+                    "You are an AI assistant and you are good at explaining what PDF documents are about. "
+                    "You will be given the user's request and a PDF document (some parts of it will be omitted for "
+                    "brevity).\n"
+                    "\n"
                     "Use the following format to describe the PDF:\n"
                     "\n"
                     "PDF TITLE: the title of the pdf\n"
@@ -380,33 +703,52 @@ async def agenerate_metadata_from_pdf_parts(pdf_text: str, user_request: str) ->
                     "question then end your answer with the word MISMATCH\n"
                     "NOTE: You shouldn't judge whether the PDF document contains any relevant information or not "
                     "solely by the presence/absence of the direct answer to the user's question in the content you "
-                    "see in the prompt above, because you are not given the full PDF document, you are given only "
-                    "parts of it. You should judge based on whether the PDF document in general seems to be the "
-                    "relevant one to the user's question or not.\n"
-                    "\n"
-                    "Begin!"
+                    "see in the prompt, because you are not given the full PDF document, you are given only parts of "
+                    "it. You should judge based on whether the PDF document in general seems to be the relevant one "
+                    "to the user's question or not."
                 ),
                 "role": "system",
             },
+            {
+                "content": "Here is what the user asked for.",
+                "role": "system",
+            },
+            {
+                "content": user_request,
+                "role": "user",
+            },
+            {
+                "content": "And here is the PDF document.",
+                "role": "system",
+            },
+            {
+                "content": f"{pdf_beginning}...\n\n...{pdf_middle}...\n\n...{pdf_end}",
+                "role": "user",
+            },
+            {
+                "content": "Begin!",
+                "role": "system",
+            },
         ],
         pl_tags=["PDF_METADATA_FROM_PARTS"],
-    ).amaterialize_content()
+    )
     answer = answer.strip()
     if answer.endswith("\nMISMATCH"):
-        raise ContentMismatchError("This PDF document does not seem to be relevant.")
+        raise ContentMismatchError("This PDF document does not seem to be relevant.", pdf=pdf_text)
     return answer
 
 
-async def render_user_utterances(ctx: InteractionContext) -> str:
+async def render_user_utterances(full_history: list[Message]) -> str:
     """
     Render user utterances as a string.
     """
     encountered_messages = set()
-    full_history = await ctx.request_messages.amaterialize_full_history()
-    for i in range(len(full_history) - 1, -1, -1):
-        if full_history[i].original_sender_alias != USER_ALIAS or full_history[i].content in encountered_messages:
-            full_history.pop(i)
-        else:
-            encountered_messages.add(full_history[i].content)
-
-    return await arender_conversation(full_history)
+    user_utterances = []
+    # walking backwards, so it is the last occurrence of a repeated utterance that is kept
+    for msg in reversed(full_history):
+        if msg.original_sender_alias == USER_ALIAS and msg.content not in encountered_messages:
+            encountered_messages.add(msg.content)
+            user_utterances.append(msg)
+    user_utterances.reverse()
+
+    return await arender_conversation(user_utterances)
@@ -0,0 +1,206 @@
+"""
+A persistent store of LLM responses and other content that is expensive to obtain (backed by SQLite), so the same
+work is not done more than once, even across different runs.
+"""
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Any, Callable, NamedTuple, Optional, TypeVar
+
+from agentforum.ext.llms.openai import _message_to_openai_dict
+from agentforum.typing import MessageType
+from agentforum.utils import amaterialize_message_sequence
+
+RESPONSE_STORE_PATH = ".response_store.sqlite3"
+# bumped whenever the way PDF texts are extracted/cleaned changes, so the texts extracted the old way are not reused
+PDF_TEXTS_TABLE = "pdf_texts_v2"
+# web pages are stored only to be revalidated with conditional requests, so neither huge nor long unused pages are worth
+# the disk space (the least recently used pages expire first)
+WEB_PAGE_MAX_SIZE = 2 * 1024 * 1024  # characters
+WEB_PAGES_TTL = 30 * 24 * 60 * 60
+
+_T = TypeVar("_T")
+
+# sqlite calls block, so they are run off the event loop - always in the same single thread, so the transactions on the
+# shared connection never interleave
+_STORE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response_store")
+
+
+class StoredWebPage(NamedTuple):
+    """
+    A web page that was downloaded before, together with its HTTP validators (for conditional requests). For HTML
+    pages the content is the HTML itself, for PDFs it is the key of the extracted text (see get_pdf_text).
+    """
+
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_type: str
+    content: str
+
+
+@lru_cache
+def get_response_store_connection() -> sqlite3.Connection:
+    """
+    Returns a connection to the response store (the store is created if it does not exist yet).
+    """
+    connection = sqlite3.connect(RESPONSE_STORE_PATH, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS llm_responses "
+        "(prompt_sha256 BLOB PRIMARY KEY, response TEXT NOT NULL, model TEXT, ts INTEGER NOT NULL)"
+    )
+    connection.execute(
+        f"CREATE TABLE IF NOT EXISTS {PDF_TEXTS_TABLE} "
+        "(pdf_text_key TEXT PRIMARY KEY, pdf_text TEXT NOT NULL, ts INTEGER NOT NULL)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS serpapi_results "
+        "(query TEXT NOT NULL, remove_gaia_links INTEGER NOT NULL, organic_results TEXT NOT NULL, "
+        "ts INTEGER NOT NULL, PRIMARY KEY (query, remove_gaia_links))"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS web_pages "
+        "(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_type TEXT NOT NULL, content TEXT NOT NULL, "
+        "ts INTEGER NOT NULL)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS web_pages_ts ON web_pages (ts)")
+    return connection
+
+
+async def arun_in_store_thread(store_func: Callable[..., _T], *args, **kwargs) -> _T:
+    """
+    Run a (blocking) response store function in the thread that is dedicated to the store and return its result.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_STORE_EXECUTOR, partial(store_func, *args, **kwargs))
+
+
+async def acalculate_prompt_sha256(prompt: MessageType, **kwargs) -> bytes:
+    """
+    Calculate a content-addressed key of a completion request. Everything besides the prompt that affects the
+    response (model, temperature, pl_tags etc.) should be passed as kwargs, so different requests don't collide.
+    """
+    # pylint: disable=protected-access
+    message_dicts = [_message_to_openai_dict(msg) for msg in await amaterialize_message_sequence(prompt)]
+    key_data = json.dumps({"prompt": message_dicts, **kwargs}, sort_keys=True, default=str)
+    return hashlib.sha256(key_data.encode("utf-8")).digest()
+
+
+def get_response(prompt_sha256: bytes) -> Optional[str]:
+    """
+    Returns a stored response or None if there is no response for the given key.
+    """
+    row = (
+        get_response_store_connection()
+        .execute("SELECT response FROM llm_responses WHERE prompt_sha256 = ?", (prompt_sha256,))
+        .fetchone()
+    )
+    return None if row is None else row[0]
+
+
+def put_response(prompt_sha256: bytes, response: str, model: Optional[str] = None) -> None:
+    """
+    Store a response under the given key (replacing the previous one, if any).
+    """
+    connection = get_response_store_connection()
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO llm_responses (prompt_sha256, response, model, ts) VALUES (?, ?, ?, ?)",
+            (prompt_sha256, response, model, int(time.time())),
+        )
+
+
+def get_pdf_text(pdf_text_key: str) -> Optional[str]:
+    """
+    Returns a stored text of a PDF document or None if there is no text for the given key.
+    """
+    row = (
+        get_response_store_connection()
+        .execute(f"SELECT pdf_text FROM {PDF_TEXTS_TABLE} WHERE pdf_text_key = ?", (pdf_text_key,))
+        .fetchone()
+    )
+    return None if row is None else row[0]
+
+
+def put_pdf_text(pdf_text_key: str, pdf_text: str) -> None:
+    """
+    Store a text of a PDF document under the given key (replacing the previous one, if any).
+    """
+    connection = get_response_store_connection()
+    with connection:
+        connection.execute(
+            f"INSERT OR REPLACE INTO {PDF_TEXTS_TABLE} (pdf_text_key, pdf_text, ts) VALUES (?, ?, ?)",
+            (pdf_text_key, pdf_text, int(time.time())),
+        )
+
+
+def get_serpapi_results(query: str, remove_gaia_links: bool, max_age: int) -> Optional[list[dict[str, Any]]]:
+    """
+    Returns stored SerpAPI organic results or None if there are no results for the given query that are younger than
+    max_age seconds.
+    """
+    row = (
+        get_response_store_connection()
+        .execute(
+            "SELECT organic_results FROM serpapi_results WHERE query = ? AND remove_gaia_links = ? AND ts >= ?",
+            (query, remove_gaia_links, int(time.time()) - max_age),
+        )
+        .fetchone()
+    )
+    return None if row is None else json.loads(row[0])
+
+
+def put_serpapi_results(query: str, remove_gaia_links: bool, organic_results: list[dict[str, Any]]) -> None:
+    """
+    Store SerpAPI organic results for the given query (replacing the previous ones, if any).
+    """
+    connection = get_response_store_connection()
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO serpapi_results (query, remove_gaia_links, organic_results, ts) "
+            "VALUES (?, ?, ?, ?)",
+            (query, remove_gaia_links, json.dumps(organic_results), int(time.time())),
+        )
+
+
+def get_web_page(url: str) -> Optional[StoredWebPage]:
+    """
+    Returns a stored web page or None if there is no page for the given URL.
+    """
+    row = (
+        get_response_store_connection()
+        .execute("SELECT etag, last_modified, content_type, content FROM web_pages WHERE url = ?", (url,))
+        .fetchone()
+    )
+    return None if row is None else StoredWebPage(*row)
+
+
+def put_web_page(url: str, web_page: StoredWebPage) -> None:
+    """
+    Store a web page under the given URL (replacing the previous one, if any). Pages bigger than WEB_PAGE_MAX_SIZE are
+    not stored, and the pages that were neither stored nor revalidated for longer than WEB_PAGES_TTL are removed.
+    """
+    if len(web_page.content) > WEB_PAGE_MAX_SIZE:
+        return
+    now = int(time.time())
+    connection = get_response_store_connection()
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO web_pages (url, etag, last_modified, content_type, content, ts) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (url, *web_page, now),
+        )
+        connection.execute("DELETE FROM web_pages WHERE ts < ?", (now - WEB_PAGES_TTL,))
+
+
+def touch_web_page(url: str) -> None:
+    """
+    Mark a stored web page as used just now (after it was successfully revalidated), so it doesn't expire.
+    """
+    connection = get_response_store_connection()
+    with connection:
+        connection.execute("UPDATE web_pages SET ts = ? WHERE url = ?", (int(time.time()), url))
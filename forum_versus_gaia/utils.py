@@ -2,23 +2,87 @@
 Utilities for the ForumVersusGaia project.
 """
 
+import asyncio
+import hashlib
 import io
 import math
 import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from functools import lru_cache
-from typing import Any
-from urllib.parse import urlparse
+from typing import Any, Iterable, NamedTuple, Optional
+from urllib.parse import urljoin, urlparse
+from weakref import WeakKeyDictionary
 
 import html2text
 import httpx
 import numpy as np
 import pypdf
+import pypdfium2 as pdfium
 from agentforum.errors import FormattedForumError
 from agentforum.models import Freeform
-from serpapi import GoogleSearch
+from selectolax.parser import HTMLParser
 
 from forum_versus_gaia import forum_versus_gaia_config
-from forum_versus_gaia.forum_versus_gaia_config import REMOVE_GAIA_LINKS
+from forum_versus_gaia.forum_versus_gaia_config import (
+    REMOVE_GAIA_LINKS,
+    SERPAPI_RATE_LIMITER,
+    get_serpapi_semaphore,
+    CACHE_SERPAPI_RESULTS,
+    SERPAPI_RESULTS_TTL,
+    FAST_HTML_CONVERSION,
+)
+from forum_versus_gaia import response_store
+from forum_versus_gaia.response_store import (
+    get_pdf_text,
+    put_pdf_text,
+    get_web_page,
+    put_web_page,
+    touch_web_page,
+    StoredWebPage,
+    arun_in_store_thread,
+)
+
+SERPAPI_URL = "https://serpapi.com/search.json"
+
+MAX_PDF_SIZE = 25 * 1024 * 1024
+MAX_PDF_PAGES = 500  # the pages beyond that are not extracted
+PDF_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+PDF_TEXT_CACHE_SIZE = 64
+HTML_CACHE_SIZE = 64
+PROBE_CACHE_SIZE = 256
+SERPAPI_RESULTS_CACHE_SIZE = 256
+NON_TEXT_HTML_TAGS = ["head", "script", "style", "noscript", "svg", "template", "iframe"]
+PDF_PROCESS_POOL_MIN_SIZE = 256 * 1024  # smaller PDFs are parsed in a thread instead
+PDF_PAGE_BATCH_SIZE = 50
+PDF_HEADER_FOOTER_MIN_PAGES = 4  # with fewer pages it is impossible to tell headers/footers from the actual text
+PDF_PAGE_EDGE_LINES = 2  # how many lines at the top and at the bottom of a page may be headers/footers/page numbers
+
+_PDF_LIGATURES = str.maketrans({"\ufb00": "ff", "\ufb01": "fi", "\ufb02": "fl", "\ufb03": "ffi", "\ufb04": "ffl"})
+_WHITESPACE_RE = re.compile(r"[ \t\u00a0]+")
+_EMPTY_LINES_RE = re.compile(r"\n{2,}")
+
+_PDF_PROCESS_POOL = ProcessPoolExecutor()
+# PDFium is not thread-safe, so the PDFs that are parsed in threads (instead of the process pool) take turns
+_PDFIUM_LOCK = threading.Lock()
+
+# the results are kept together with the time they were cached at, so they expire after SERPAPI_RESULTS_TTL
+_SERPAPI_RESULTS_CACHE: OrderedDict[tuple[str, bool], tuple[float, list[dict[str, Any]]]] = OrderedDict()
+_PDF_TEXT_CACHE: OrderedDict[str, str] = OrderedDict()
+_PDF_TEXT_KEYS_BY_URL: dict[str, str] = {}
+_HTML_CACHE: OrderedDict[str, str] = OrderedDict()
+_PDF_TEXT_FUTURES: dict[str, asyncio.Future[str]] = {}
+_DOWNLOAD_FUTURES: dict[str, asyncio.Future[tuple[str, bool]]] = {}
+_PROBE_RESULTS: OrderedDict[str, tuple[str, int]] = OrderedDict()
+_PROBE_FUTURES: dict[str, asyncio.Future[tuple[str, int]]] = {}
+_PREFETCH_TASKS: set[asyncio.Task] = set()
+# connections of a client cannot be shared between event loops, hence one client per loop
+_HTTPX_CLIENTS: WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient] = WeakKeyDictionary()
+_SERPAPI_HTTPX_CLIENTS: WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient] = WeakKeyDictionary()
 
 
 class ForumVersusGaiaError(FormattedForumError):
@@ -54,6 +118,12 @@ class ContentAlreadySeenError(ForumVersusGaiaError):
     """
 
 
+class ContentTooLargeError(ForumVersusGaiaError):
+    """
+    Raised when the content that was found on the web is too large to be downloaded and processed.
+    """
+
+
 class TooManyStepsError(ForumVersusGaiaError):
     """
     Raised when an agent takes too many steps to complete.
@@ -66,7 +136,7 @@ def is_valid_url(text: str) -> bool:
     """
     try:
         result = urlparse(text)
-        return all([result.scheme, result.netloc])
+        return bool(result.scheme and result.netloc)
     except ValueError:
         return False
 
@@ -79,38 +149,131 @@ def assert_valid_url(url: str, error_class: type[BaseException] = NotAUrlError)
         raise error_class(url)
 
 
+def is_pdf_url(url: str) -> bool:
+    """
+    Returns True if the given URL looks like it leads to a PDF document (judging by the URL alone).
+    """
+    return urlparse(url.strip()).path.lower().endswith(".pdf")
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalize a URL, so the same URL written slightly differently (surrounding whitespace, fragment, letter case of
+    the host) is recognized as the same URL.
+    """
+    parsed_url = urlparse(url.strip())
+    return parsed_url._replace(netloc=parsed_url.netloc.lower(), fragment="").geturl()
+
+
 def get_httpx_client() -> httpx.AsyncClient:
     """
-    Returns a httpx client with the settings we want.
-    """
-    return httpx.AsyncClient(
-        follow_redirects=True,
-        verify=False,
-        headers={
-            "User-Agent": (
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/58.0.3029.110 Safari/537.36"
-            ),
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            "Accept-Language": "en-US,en;q=0.5",
-            "Referer": "https://www.google.com/",
-        },
-    )
+    Returns a httpx client with the settings we want. The client (and hence its pool of keep-alive connections) is
+    shared by all the requests that are made within the same event loop.
+    """
+    event_loop = asyncio.get_running_loop()
+    httpx_client = _HTTPX_CLIENTS.get(event_loop)
+    if httpx_client is None:
+        httpx_client = httpx.AsyncClient(
+            follow_redirects=True,
+            verify=False,
+            headers={
+                "User-Agent": (
+                    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                    "Chrome/58.0.3029.110 Safari/537.36"
+                ),
+                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+                "Accept-Language": "en-US,en;q=0.5",
+                "Referer": "https://www.google.com/",
+            },
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            timeout=30,
+            # concurrent requests to the same host (prefetched search results, for example) share one connection
+            http2=True,
+        )
+        _HTTPX_CLIENTS[event_loop] = httpx_client
+    return httpx_client
 
 
-@lru_cache
-def get_serpapi_results(query: str, remove_gaia_links: bool = REMOVE_GAIA_LINKS) -> list[dict[str, Any]]:
+def get_serpapi_httpx_client() -> httpx.AsyncClient:
     """
-    Returns a list of organic results from SerpAPI for a given query.
+    Returns a httpx client for SerpAPI requests (one per event loop, just like get_httpx_client). Unlike the client
+    that is used to download arbitrary web pages, this one verifies TLS certificates, because the SerpAPI key is sent
+    with every request.
     """
-    # TODO Oleksandr: make this function async by replacing SerpAPI python client with plain aiohttp ?
-    search = GoogleSearch(
-        {
-            "q": query,
-            "api_key": os.environ["SERPAPI_API_KEY"],
-        }
-    )
-    organic_results = search.get_dict()["organic_results"]
+    event_loop = asyncio.get_running_loop()
+    httpx_client = _SERPAPI_HTTPX_CLIENTS.get(event_loop)
+    if httpx_client is None:
+        httpx_client = httpx.AsyncClient(timeout=30, http2=True)
+        _SERPAPI_HTTPX_CLIENTS[event_loop] = httpx_client
+    return httpx_client
+
+
+async def aclose_httpx_client() -> None:
+    """
+    Close the httpx clients of the current event loop (if there are any), so their keep-alive connections are closed
+    gracefully. Should be called when nothing is going to be downloaded in this event loop anymore.
+    """
+    event_loop = asyncio.get_running_loop()
+    for httpx_clients in (_HTTPX_CLIENTS, _SERPAPI_HTTPX_CLIENTS):
+        httpx_client = httpx_clients.pop(event_loop, None)
+        if httpx_client is not None:
+            await httpx_client.aclose()
+
+
+async def aget_serpapi_results(query: str, remove_gaia_links: bool = REMOVE_GAIA_LINKS) -> list[dict[str, Any]]:
+    """
+    Returns a list of organic results from SerpAPI for a given query. The results are cached in memory (for at most
+    SERPAPI_RESULTS_TTL) and, if CACHE_SERPAPI_RESULTS is on, also looked up in (and written through to) the persistent
+    response store.
+    """
+    serpapi_key = (query, remove_gaia_links)
+    cached = _SERPAPI_RESULTS_CACHE.get(serpapi_key)
+    if cached is not None:
+        cached_at, organic_results = cached
+        if time.time() - cached_at <= SERPAPI_RESULTS_TTL:
+            _SERPAPI_RESULTS_CACHE.move_to_end(serpapi_key)
+            return organic_results
+        del _SERPAPI_RESULTS_CACHE[serpapi_key]
+
+    organic_results = None
+    if CACHE_SERPAPI_RESULTS:
+        organic_results = await arun_in_store_thread(
+            response_store.get_serpapi_results, query, remove_gaia_links, max_age=SERPAPI_RESULTS_TTL
+        )
+    if organic_results is None:
+        organic_results = await arequest_serpapi_results(query, remove_gaia_links)
+        if CACHE_SERPAPI_RESULTS:
+            await arun_in_store_thread(response_store.put_serpapi_results, query, remove_gaia_links, organic_results)
+
+    _SERPAPI_RESULTS_CACHE[serpapi_key] = time.time(), organic_results
+    if len(_SERPAPI_RESULTS_CACHE) > SERPAPI_RESULTS_CACHE_SIZE:
+        _SERPAPI_RESULTS_CACHE.popitem(last=False)
+    return organic_results
+
+
+async def arequest_serpapi_results(query: str, remove_gaia_links: bool = REMOVE_GAIA_LINKS) -> list[dict[str, Any]]:
+    """
+    Request a list of organic results from SerpAPI for a given query (no caching). SerpAPI is called directly with an
+    async httpx client, so the event loop is not blocked while waiting for the search. Both the number of simultaneous
+    searches and the rate at which they are started are limited.
+    """
+    async with get_serpapi_semaphore():
+        await SERPAPI_RATE_LIMITER.aacquire()
+        httpx_response = await get_serpapi_httpx_client().get(
+            SERPAPI_URL,
+            params={
+                "engine": "google",
+                "q": query,
+                "api_key": os.environ["SERPAPI_API_KEY"],
+            },
+        )
+    httpx_response.raise_for_status()
+
+    serpapi_response = httpx_response.json()
+    if "organic_results" not in serpapi_response:
+        # SerpAPI reports some problems (a search without results, for example) in the body rather than with a status
+        raise ContentNotFoundError(serpapi_response.get("error") or f"No search results for: {query}")
+    organic_results = serpapi_response["organic_results"]
     if remove_gaia_links:
         # we don't want the agents to look up answers in the GAIA benchmark itself
         organic_results = [
@@ -132,75 +295,513 @@ def get_serpapi_results(query: str, remove_gaia_links: bool = REMOVE_GAIA_LINKS)
 async def adownload_from_web(url: str) -> tuple[str, bool]:
     """
     Download content from the web and return it as a string. If the content is a PDF, return the text extracted from the
-    PDF as well. Returns a tuple of the content and a boolean indicating whether the content is a PDF.
-    """
-    async with get_httpx_client() as httpx_client:
-        httpx_response = await httpx_client.get(url)
-
-    if "application/pdf" in httpx_response.headers["content-type"]:
-        pdf_reader = pypdf.PdfReader(io.BytesIO(httpx_response.content))
-        pdf_text = "\n".join([page.extract_text() for page in pdf_reader.pages])
-        if forum_versus_gaia_config.CAPTURE_MOCKING_DATA:
-            forum_versus_gaia_config.CAPTURED_DATA["web"].append(
-                {
-                    "url": url,
-                    "content_type": httpx_response.headers["content-type"],
-                    "content": pdf_text,
-                }
-            )
+    PDF as well. Returns a tuple of the content and a boolean indicating whether the content is a PDF. Concurrent
+    downloads of the same URL are coalesced into one.
+    """
+    pdf_text = _PDF_TEXT_CACHE.get(_PDF_TEXT_KEYS_BY_URL.get(url))
+    if pdf_text is not None:
+        # this PDF was already downloaded and parsed during this run
+        _capture_web_content(url=url, content_type="application/pdf", content=pdf_text)
         return pdf_text, True
 
-    if "text/html" not in httpx_response.headers["content-type"]:
-        raise ContentMismatchError(
-            f"Expected a PDF or HTML document but got {httpx_response.headers['content-type']} instead.",
-            page_url=url,
+    html = _HTML_CACHE.get(url)
+    if html is not None:
+        # this page was already downloaded during this run
+        _HTML_CACHE.move_to_end(url)
+        _capture_web_content(url=url, content_type="text/html", content=html)
+        return html, False
+
+    download_future = _DOWNLOAD_FUTURES.get(url)
+    if download_future is None:
+        # nobody is downloading this URL at the moment
+        download_future = asyncio.create_task(_adownload_from_web_uncached(url))
+        _DOWNLOAD_FUTURES[url] = download_future
+        download_future.add_done_callback(lambda _: _DOWNLOAD_FUTURES.pop(url, None))
+    # shielded, so one of the waiters being cancelled doesn't cancel the download for the others
+    return await asyncio.shield(download_future)
+
+
+def prefetch_from_web(urls: Iterable[str]) -> None:
+    """
+    Start downloading the given URLs in the background, so the downloads overlap with whatever happens next (an LLM
+    call, for example). The results land in the same caches that adownload_from_web looks into. Errors are ignored -
+    whoever actually needs the content will get the error when they ask for it.
+    """
+    for url in urls:
+        prefetch_task = asyncio.create_task(adownload_from_web(url))
+        # the event loop only keeps weak references to tasks
+        _PREFETCH_TASKS.add(prefetch_task)
+        prefetch_task.add_done_callback(_discard_prefetch_task)
+
+
+def _discard_prefetch_task(prefetch_task: asyncio.Task) -> None:
+    _PREFETCH_TASKS.discard(prefetch_task)
+    if not prefetch_task.cancelled():
+        prefetch_task.exception()  # mark the exception as retrieved, so asyncio doesn't log it
+
+
+async def _adownload_from_web_uncached(url: str) -> tuple[str, bool]:
+    stored_page, stored_content = await arun_in_store_thread(_get_stored_web_page, url)
+    conditional_headers = {}
+    if stored_page is not None:
+        # the server doesn't send the content again if it didn't change since the last download
+        if stored_page.etag:
+            conditional_headers["If-None-Match"] = stored_page.etag
+        if stored_page.last_modified:
+            conditional_headers["If-Modified-Since"] = stored_page.last_modified
+    elif not is_pdf_url(url):
+        # for URLs that look like PDFs the probe would just be an extra round-trip (the size of the PDF is checked
+        # while it is being downloaded anyway)
+        await aassert_pdf_or_html(url)
+
+    async with get_httpx_client().stream("GET", url, headers=conditional_headers) as httpx_response:
+        if stored_page is not None and httpx_response.status_code == httpx.codes.NOT_MODIFIED:
+            await arun_in_store_thread(touch_web_page, url)
+            return _reuse_stored_web_page(url, stored_page, stored_content)
+
+        content_type = httpx_response.headers["content-type"]
+        if "application/pdf" in content_type:
+            pdf_content, pdf_text_key = await _aread_pdf_content(httpx_response, url)
+        elif "text/html" in content_type:
+            await httpx_response.aread()
+            if not httpx_response.is_success:
+                # an error page is still shown to the agent (it may point to where the document went), but it is
+                # neither cached nor stored - otherwise it would be served as the page itself from then on
+                _capture_web_content(url=url, content_type=content_type, content=httpx_response.text)
+                return httpx_response.text, False
+            await _astore_web_page(url, httpx_response, content_type, httpx_response.text)
+            return _cache_html(url, content_type, httpx_response.text), False
+        else:
+            # the body is never downloaded in this case
+            raise ContentMismatchError(
+                f"Expected a PDF or HTML document but got {content_type} instead.",
+                page_url=url,
+            )
+
+    # the connection is already released at this point, so it doesn't sit idle while the PDF is being parsed
+    pdf_text = await aextract_pdf_text(pdf_text_key, pdf_content)
+    if httpx_response.is_success:
+        await _astore_web_page(url, httpx_response, content_type, pdf_text_key)
+        _PDF_TEXT_KEYS_BY_URL[url] = pdf_text_key
+    _capture_web_content(url=url, content_type=content_type, content=pdf_text)
+    return pdf_text, True
+
+
+def _get_stored_web_page(url: str) -> tuple[Optional[StoredWebPage], Optional[str]]:
+    """
+    Returns a stored web page that can be revalidated with a conditional request along with its content (the PDF text
+    in case of PDFs) or a tuple of Nones if there is no such page. Blocks on the response store, so it should be run
+    with arun_in_store_thread.
+    """
+    stored_page = get_web_page(url)
+    if stored_page is None:
+        return None, None
+    if "application/pdf" in stored_page.content_type:
+        stored_content = get_pdf_text(stored_page.content)
+        if stored_content is None:
+            return None, None
+        return stored_page, stored_content
+    return stored_page, stored_page.content
+
+
+async def _astore_web_page(url: str, httpx_response: httpx.Response, content_type: str, content: str) -> None:
+    etag = httpx_response.headers.get("etag")
+    last_modified = httpx_response.headers.get("last-modified")
+    if etag or last_modified:
+        # without validators a stored page could never be reused
+        await arun_in_store_thread(put_web_page, url, StoredWebPage(etag, last_modified, content_type, content))
+
+
+def _reuse_stored_web_page(url: str, stored_page: StoredWebPage, stored_content: str) -> tuple[str, bool]:
+    if "application/pdf" in stored_page.content_type:
+        _PDF_TEXT_CACHE[stored_page.content] = stored_content
+        if len(_PDF_TEXT_CACHE) > PDF_TEXT_CACHE_SIZE:
+            _PDF_TEXT_CACHE.popitem(last=False)
+        _PDF_TEXT_KEYS_BY_URL[url] = stored_page.content
+        _capture_web_content(url=url, content_type=stored_page.content_type, content=stored_content)
+        return stored_content, True
+    return _cache_html(url, stored_page.content_type, stored_content), False
+
+
+def _cache_html(url: str, content_type: str, html: str) -> str:
+    _HTML_CACHE[url] = html
+    if len(_HTML_CACHE) > HTML_CACHE_SIZE:
+        _HTML_CACHE.popitem(last=False)
+    _capture_web_content(url=url, content_type=content_type, content=html)
+    return html
+
+
+async def _aread_pdf_content(httpx_response: httpx.Response, url: str) -> tuple[bytes, str]:
+    """
+    Read the body of a streamed PDF response. The content is hashed as it arrives and the download is aborted as soon
+    as MAX_PDF_SIZE is exceeded (servers don't always report the size upfront). Returns the content and its hash.
+    """
+    content_length = int(httpx_response.headers.get("content-length") or 0)
+    if content_length > MAX_PDF_SIZE:
+        # not a single byte of the body needs to be downloaded to know that
+        raise ContentTooLargeError(f"The PDF is too large ({content_length} bytes).", page_url=url)
+
+    pdf_chunks = []
+    pdf_size = 0
+    pdf_hash = hashlib.blake2b(digest_size=16)
+    async for pdf_chunk in httpx_response.aiter_bytes(PDF_DOWNLOAD_CHUNK_SIZE):
+        pdf_size += len(pdf_chunk)
+        if pdf_size > MAX_PDF_SIZE:
+            raise ContentTooLargeError(f"The PDF is too large (more than {MAX_PDF_SIZE} bytes).", page_url=url)
+        pdf_hash.update(pdf_chunk)
+        pdf_chunks.append(pdf_chunk)
+    return b"".join(pdf_chunks), pdf_hash.hexdigest()
+
+
+async def aprobe_content_type(url: str) -> tuple[str, int]:
+    """
+    Find out the content type and the size of what a URL leads to without downloading the whole content. A HEAD
+    request is tried first. For servers that don't support HEAD only the first bytes of the content are requested
+    (PDFs are then also recognized by their magic bytes). Returns an empty content type and zero size if the server
+    didn't say. The results are remembered for the rest of the run and concurrent probes of the same URL (a prefetch
+    and a PDF search, for example) are coalesced into one.
+    """
+    probe_result = _PROBE_RESULTS.get(url)
+    if probe_result is not None:
+        return probe_result
+
+    probe_future = _PROBE_FUTURES.get(url)
+    if probe_future is None:
+        # nobody is probing this URL at the moment
+        probe_future = asyncio.create_task(_aprobe_content_type_uncached(url))
+        _PROBE_FUTURES[url] = probe_future
+        probe_future.add_done_callback(lambda _: _PROBE_FUTURES.pop(url, None))
+    # shielded, so one of the waiters being cancelled doesn't cancel the probe for the others
+    return await asyncio.shield(probe_future)
+
+
+async def _aprobe_content_type_uncached(url: str) -> tuple[str, int]:
+    httpx_client = get_httpx_client()
+    try:
+        head_response = await httpx_client.head(url)
+        head_response.raise_for_status()
+        content_type = head_response.headers.get("content-type", "")
+        content_length = int(head_response.headers.get("content-length") or 0)
+    except (httpx.HTTPError, ValueError):
+        content_type = ""
+        content_length = 0
+        try:
+            async with httpx_client.stream("GET", url, headers={"Range": "bytes=0-4095"}) as probe_response:
+                content_type = probe_response.headers.get("content-type", "")
+                async for first_bytes in probe_response.aiter_bytes():
+                    if first_bytes.startswith(b"%PDF-"):
+                        content_type = "application/pdf"
+                    break
+        except httpx.HTTPError:
+            pass  # let the actual download deal with it
+
+    _PROBE_RESULTS[url] = content_type, content_length
+    if len(_PROBE_RESULTS) > PROBE_CACHE_SIZE:
+        _PROBE_RESULTS.popitem(last=False)
+    return content_type, content_length
+
+
+async def aassert_pdf_or_html(url: str) -> None:
+    """
+    Make sure a URL leads to a PDF or an HTML document (and that the PDF is not too big) without downloading the whole
+    content (see aprobe_content_type). Raises ContentMismatchError or ContentTooLargeError.
+    """
+    content_type, content_length = await aprobe_content_type(url)
+    if not content_type:
+        return  # the server didn't say, the actual download will tell
+
+    if "application/pdf" in content_type:
+        if content_length > MAX_PDF_SIZE:
+            raise ContentTooLargeError(f"The PDF is too large ({content_length} bytes).", page_url=url)
+    elif "text/html" not in content_type:
+        raise ContentMismatchError(f"Expected a PDF or HTML document but got {content_type} instead.", page_url=url)
+
+
+async def afind_pdf_url(urls: Iterable[str]) -> Optional[str]:
+    """
+    Probe the given URLs concurrently and return the first one (in the given order) that leads to a PDF document or
+    None if none of them does. Probing errors are ignored.
+    """
+    urls = list(urls)
+    probe_results = await asyncio.gather(*(aprobe_content_type(url) for url in urls), return_exceptions=True)
+    for url, probe_result in zip(urls, probe_results):
+        if not isinstance(probe_result, BaseException) and "application/pdf" in probe_result[0]:
+            return url
+    return None
+
+
+async def aextract_pdf_text(pdf_text_key: str, pdf_content: bytes) -> str:
+    """
+    Extract text from a PDF document. The texts are cached by pdf_text_key (the hash of the PDF content), so the same
+    PDF is never parsed twice (not even across different runs, because the texts are persisted in the response
+    store). Concurrent extractions of the same PDF are coalesced into one.
+    """
+    pdf_text = _PDF_TEXT_CACHE.get(pdf_text_key)
+    if pdf_text is not None:
+        _PDF_TEXT_CACHE.move_to_end(pdf_text_key)
+        return pdf_text
+
+    pdf_text_future = _PDF_TEXT_FUTURES.get(pdf_text_key)
+    if pdf_text_future is None:
+        # nobody is extracting this PDF at the moment
+        pdf_text_future = asyncio.create_task(_aextract_pdf_text_uncached(pdf_text_key, pdf_content))
+        _PDF_TEXT_FUTURES[pdf_text_key] = pdf_text_future
+        # cleanup happens no matter how the extraction ends (success, error or cancellation)
+        pdf_text_future.add_done_callback(lambda _: _PDF_TEXT_FUTURES.pop(pdf_text_key, None))
+    # shielded, so one of the waiters being cancelled doesn't cancel the extraction for the others
+    return await asyncio.shield(pdf_text_future)
+
+
+async def _aextract_pdf_text_uncached(pdf_text_key: str, pdf_content: bytes) -> str:
+    pdf_text = await arun_in_store_thread(get_pdf_text, pdf_text_key)
+    if pdf_text is None:
+        # parsing is CPU-bound, so it is moved off the event loop (and, for bigger PDFs, out of this process, so the
+        # GIL doesn't serialize it with everything else)
+        if len(pdf_content) < PDF_PROCESS_POOL_MIN_SIZE:
+            # not worth the pickling overhead
+            pdf_text = await asyncio.to_thread(extract_pdf_text, pdf_content, 0, MAX_PDF_PAGES)
+        else:
+            page_texts = await _aextract_pdf_page_texts_in_process_pool(pdf_content)
+            # headers/footers are detected across all the pages of the document, not batch by batch, so the same PDF
+            # is cleaned the same way no matter which path it took
+            pdf_text = "\n".join(await asyncio.to_thread(clean_pdf_pages, page_texts))
+        await arun_in_store_thread(put_pdf_text, pdf_text_key, pdf_text)
+
+    _PDF_TEXT_CACHE[pdf_text_key] = pdf_text
+    if len(_PDF_TEXT_CACHE) > PDF_TEXT_CACHE_SIZE:
+        _PDF_TEXT_CACHE.popitem(last=False)
+    return pdf_text
+
+
+async def _aextract_pdf_page_texts_in_process_pool(pdf_content: bytes) -> list[str]:
+    loop = asyncio.get_running_loop()
+    page_num = min(await asyncio.to_thread(count_pdf_pages, pdf_content), MAX_PDF_PAGES)
+    # pages are independent of each other, so batches of pages are parsed by different worker processes in parallel
+    # (threads wouldn't help here - neither PDFium nor pypdf are thread-safe)
+    batch_page_texts = await asyncio.gather(
+        *[
+            loop.run_in_executor(
+                _PDF_PROCESS_POOL,
+                extract_pdf_page_texts,
+                pdf_content,
+                start,
+                min(start + PDF_PAGE_BATCH_SIZE, page_num),
+            )
+            for start in range(0, page_num, PDF_PAGE_BATCH_SIZE)
+        ]
+    )
+    return [page_text for page_texts in batch_page_texts for page_text in page_texts]
+
+
+def count_pdf_pages(pdf_content: bytes) -> int:
+    """
+    Count the number of pages in a PDF document.
+    """
+    with _PDFIUM_LOCK:
+        try:
+            pdf = pdfium.PdfDocument(pdf_content)
+        except pdfium.PdfiumError:
+            pdf = None
+        if pdf is not None:
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+    return len(pypdf.PdfReader(io.BytesIO(pdf_content)).pages)
+
+
+def extract_pdf_text(pdf_content: bytes, start_page: int = 0, end_page: Optional[int] = None) -> str:
+    """
+    Extract text from a PDF document (synchronously). Optionally, only a range of pages is extracted. The text is
+    cleaned with clean_pdf_pages.
+    """
+    return "\n".join(clean_pdf_pages(extract_pdf_page_texts(pdf_content, start_page, end_page)))
+
+
+def extract_pdf_page_texts(pdf_content: bytes, start_page: int = 0, end_page: Optional[int] = None) -> list[str]:
+    """
+    Extract the raw texts of the pages of a PDF document (synchronously). Optionally, only a range of pages is
+    extracted. PDFium is used for extraction because it is much faster than pypdf. pypdf is only a fallback for the
+    PDFs that PDFium fails to open.
+    """
+    with _PDFIUM_LOCK:
+        try:
+            pdf = pdfium.PdfDocument(pdf_content)
+        except pdfium.PdfiumError:
+            pdf = None
+        if pdf is not None:
+            try:
+                page_range = range(len(pdf))[start_page:end_page]
+                # PDFium uses Windows line endings
+                return [
+                    pdf[page_idx].get_textpage().get_text_bounded().replace("\r\n", "\n") for page_idx in page_range
+                ]
+            finally:
+                pdf.close()
+    pdf_reader = pypdf.PdfReader(io.BytesIO(pdf_content))
+    page_range = range(len(pdf_reader.pages))[start_page:end_page]
+    return [pdf_reader.pages[page_idx].extract_text() for page_idx in page_range]
+
+
+def clean_pdf_pages(page_texts: list[str]) -> list[str]:
+    """
+    Remove what only wastes LLM tokens from the texts of PDF pages: repeated whitespace, empty lines, page numbers
+    (digit-only lines that follow the sequence of the pages) and headers/footers (lines that repeat on more than half
+    of the pages). Page numbers and headers/footers are only looked for near the top and the bottom of the pages.
+    Ligatures are replaced with plain letters.
+    """
+    pages_lines = [
+        [line for line in (_WHITESPACE_RE.sub(" ", line).strip() for line in page_text.split("\n")) if line]
+        for page_text in (page_text.translate(_PDF_LIGATURES) for page_text in page_texts)
+    ]
+    pages_edges = [_get_page_edge_indices(page_lines) for page_lines in pages_lines]
+    repeated_lines = set()
+    if len(pages_lines) >= PDF_HEADER_FOOTER_MIN_PAGES:
+        line_page_counts = Counter(
+            line
+            for page_lines, page_edges in zip(pages_lines, pages_edges)
+            for line in {page_lines[line_idx] for line_idx in page_edges}
+        )
+        repeated_lines = {line for line, count in line_page_counts.items() if count > len(pages_lines) / 2}
+    page_number_offset = _find_page_number_offset(pages_lines, pages_edges)
+
+    cleaned_pages = []
+    for page_idx, (page_lines, page_edges) in enumerate(zip(pages_lines, pages_edges)):
+        page_number = None if page_number_offset is None else str(page_idx + page_number_offset)
+        cleaned_pages.append(
+            "\n".join(
+                line
+                for line_idx, line in enumerate(page_lines)
+                # lines in the middle of a page are table cells, labels etc. even if they repeat on every page
+                if line_idx not in page_edges or (line not in repeated_lines and line != page_number)
+            )
         )
+    return cleaned_pages
+
+
+def _get_page_edge_indices(page_lines: list[str]) -> set[int]:
+    return set(range(min(PDF_PAGE_EDGE_LINES, len(page_lines)))) | set(
+        range(max(len(page_lines) - PDF_PAGE_EDGE_LINES, 0), len(page_lines))
+    )
+
+
+def _find_page_number_offset(pages_lines: list[list[str]], pages_edges: list[set[int]]) -> Optional[int]:
+    """
+    Find the difference between the printed page numbers and the page indices (e.g. 1 if the first page is numbered
+    "1"). None is returned if no digit-only lines at the edges of the pages follow the sequence of the pages.
+    """
+    offset_page_counts = Counter(
+        offset
+        for page_idx, (page_lines, page_edges) in enumerate(zip(pages_lines, pages_edges))
+        for offset in {
+            int(page_lines[line_idx]) - page_idx for line_idx in page_edges if page_lines[line_idx].isdecimal()
+        }
+    )
+    if not offset_page_counts:
+        return None
+    offset, page_count = offset_page_counts.most_common(1)[0]
+    # a single page cannot show a sequence
+    if page_count < 2 or page_count <= len(pages_lines) / 2:
+        return None
+    return offset
+
 
+def _capture_web_content(url: str, content_type: str, content: str) -> None:
     if forum_versus_gaia_config.CAPTURE_MOCKING_DATA:
         forum_versus_gaia_config.CAPTURED_DATA["web"].append(
             {
                 "url": url,
-                "content_type": httpx_response.headers["content-type"],
-                "content": httpx_response.text,
+                "content_type": content_type,
+                "content": content,
             }
         )
-    return httpx_response.text, False
 
 
+@lru_cache(maxsize=HTML_CACHE_SIZE)
 def convert_html_to_markdown(html: str, baseurl: str = "") -> str:
     """
-    Convert HTML to markdown (the best effort).
+    Convert HTML to markdown (the best effort). The conversion is cached, because the same pages tend to be revisited
+    (the hash of the page that comes from _HTML_CACHE is already computed, so cache lookups are cheap).
+    """
+    if not FAST_HTML_CONVERSION:
+        h = html2text.HTML2Text(baseurl=baseurl, bodywidth=0)
+        h.ignore_links = False
+        return h.handle(html)
+
+    # selectolax parses HTML in C (and, unlike html2text, it isn't GPL) - only the text and the links (in markdown
+    # format) are kept, which is all that is needed to pick the next url
+    tree = HTMLParser(html)
+    tree.strip_tags(NON_TEXT_HTML_TAGS)
+    seen_link_urls = set()
+    for link in tree.css("a[href]"):
+        link_text = link.text(separator=" ", strip=True)
+        link_url = urljoin(baseurl, link.attributes["href"] or "")
+        if link_url in seen_link_urls or not link_url.startswith(("http://", "https://")):
+            # repeated links (menus, footers) and the ones that can't lead to a document (javascript:, mailto: etc.)
+            # would only waste prompt tokens - their text is enough
+            link.replace_with(link_text)
+            continue
+        if not link_text and not is_pdf_url(link_url):
+            # links without text (images, icons) are kept only if they lead to a PDF - the url is not marked as seen,
+            # so the same link with text (a title next to a thumbnail, for example) still makes it into the output
+            link.replace_with("")
+            continue
+        seen_link_urls.add(link_url)
+        link.replace_with(f"[{link_text}]({link_url})")
+    root = tree.body or tree.root
+    if root is None:
+        return ""
+    # whitespace-only text nodes turn into empty lines otherwise
+    return _EMPTY_LINES_RE.sub("\n", root.text(separator="\n", strip=True))
+
+
+class LogprobStats(NamedTuple):
+    """
+    Statistics of the log probabilities of tokens found in a message metadata.
+    """
+
+    perplexity: float
+    geometric_mean_of_probabilities: float
+    min_probability: float
+
+
+def calculate_logprob_stats(openai_metadata: Freeform) -> LogprobStats:
+    """
+    Calculate perplexity, the geometric mean of probabilities and the minimum probability of tokens found in a message
+    metadata in one go (the log probabilities are collected only once).
     """
-    h = html2text.HTML2Text(baseurl=baseurl, bodywidth=0)
-    h.ignore_links = False
-    return h.handle(html)
+    log_probs = _collect_log_probs(openai_metadata)
+    average_log_prob = log_probs.mean()
+    return LogprobStats(
+        perplexity=math.exp(-average_log_prob),
+        geometric_mean_of_probabilities=math.exp(average_log_prob),
+        min_probability=math.exp(log_probs.min()),
+    )
 
 
 def calculate_perplexity(openai_metadata: Freeform) -> float:
     """
     Calculate perplexity from the log probabilities of tokens found in a message metadata.
     """
-    log_probs = [logprob.logprob for logprob in openai_metadata.openai_logprobs]
-    average_log_prob = np.mean(log_probs)
-    perplexity = np.exp(-average_log_prob)
-    return perplexity
+    return math.exp(-_collect_log_probs(openai_metadata).mean())
 
 
 def calculate_geometric_mean_of_probabilities(openai_metadata: Freeform) -> float:
     """
     Calculate the geometric mean of probabilities from the log probabilities of tokens found in a message metadata.
     """
-    log_probs = [logprob.logprob for logprob in openai_metadata.openai_logprobs]
-    probs = np.exp(log_probs)
-    geometric_mean = np.prod(probs) ** (1 / len(probs))
-    return geometric_mean
+    # exp of the mean log probability is the same thing as the n-th root of the product of probabilities, but the
+    # product doesn't underflow for long messages this way
+    return math.exp(_collect_log_probs(openai_metadata).mean())
 
 
 def find_min_probability(openai_metadata: Freeform) -> float:
     """
     Find the minimum probability of tokens found in a message metadata.
     """
-    log_probs = [logprob.logprob for logprob in openai_metadata.openai_logprobs]
-    min_log_prob = min(log_probs)
-    min_probability = math.exp(min_log_prob)
-    return min_probability
+    return math.exp(_collect_log_probs(openai_metadata).min())
+
+
+def _collect_log_probs(openai_metadata: Freeform) -> np.ndarray:
+    # no intermediate list - the array is filled straight from the generator
+    return np.fromiter((logprob.logprob for logprob in openai_metadata.openai_logprobs), dtype=np.float64)
@@ -20,13 +20,17 @@ async def amain() -> None:
     Run the assistant on a question from the GAIA dataset.
     """
     from forum_versus_gaia.gaia_agent import arun_assistant
+    from forum_versus_gaia.utils import aclose_httpx_client
 
     question = (
         "In Valentina Re’s contribution to the 2017 book “World Building: Transmedia, Fans, Industries”, what "
         "horror movie does the author cite as having popularized metalepsis between a dream world and reality? "
         "Use the complete name with article if any."
     )
-    await arun_assistant(question)
+    try:
+        await arun_assistant(question)
+    finally:
+        await aclose_httpx_client()
 
 
 if __name__ == "__main__":
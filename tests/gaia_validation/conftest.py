@@ -2,51 +2,86 @@
 Pytest configuration with functions to mock calls to OpenAI.
 """
 
-import copy
-import importlib
+import ast
+import hashlib
+import json
 import re
-import sys
+from dataclasses import dataclass
 from functools import partial
-from glob import glob
 from pathlib import Path
-from typing import Any, Optional, Iterable
-from unittest.mock import patch, MagicMock
+from typing import Any, AsyncIterator, Optional, Iterable
+from unittest.mock import patch
 
 import pytest
+import pytest_asyncio
 from agentforum.ext.llms.openai import _message_to_openai_dict, _OpenAIStreamedMessage
 from agentforum.typing import MessageType
 from agentforum.utils import amaterialize_message_sequence
+from pytest_asyncio import is_async_test
 
 from forum_versus_gaia.forum_versus_gaia_config import REMOVE_GAIA_LINKS, MOCK_CALLS
-from forum_versus_gaia.utils import ContentMismatchError
+from forum_versus_gaia.utils import ContentMismatchError, aclose_httpx_client
+
+_TOKEN_SPLIT_RE = re.compile(r"(?<=\S)(?=\s+)")
+
+
+def pytest_collection_modifyitems(items: list[pytest.Item]) -> None:
+    """
+    Run all the async tests in one event loop, so the per-loop resources (the httpx client with its connection pool,
+    the rate limiters etc.) are shared by the whole session instead of being set up anew for every test.
+    """
+    session_scope_marker = pytest.mark.asyncio(scope="session")
+    for item in items:
+        if is_async_test(item):
+            item.add_marker(session_scope_marker, append=False)
+
+
+@pytest_asyncio.fixture(scope="session", autouse=True)
+async def close_httpx_client() -> AsyncIterator[None]:
+    """
+    Close the httpx client of the session event loop once all the tests are done.
+    """
+    yield
+    await aclose_httpx_client()
+
+
+@pytest.fixture(scope="session", name="mocking_data")
+def fixture_mocking_data() -> dict[str, Any]:
+    """
+    Load the captured responses only once per test session (they are never modified by the tests).
+    """
+    return _load_gaia_mocking_data()
 
 
 @pytest.fixture(autouse=MOCK_CALLS)
-def patch_openai() -> None:
+def patch_openai(mocking_data: dict[str, Any]) -> None:
     """
     Patch the OpenAI API calls to use captured responses.
     """
-    mocking_data = _load_gaia_mocking_data()
     with (
         patch(
             "agentforum.ext.llms.openai._make_openai_request",
             side_effect=partial(_make_openai_request_mock, mocking_data["openai"]),
         ),
         patch(
-            "forum_versus_gaia.utils.get_serpapi_results",
-            side_effect=partial(_get_serpapi_results_mock, mocking_data["serpapi"]),
+            "forum_versus_gaia.utils.arequest_serpapi_results",
+            side_effect=partial(_arequest_serpapi_results_mock, mocking_data["serpapi"]),
         ),
         patch(
             "forum_versus_gaia.utils.adownload_from_web",
             side_effect=partial(_adownload_from_web_mock, mocking_data["web"]),
         ),
+        patch(
+            "forum_versus_gaia.utils.aprobe_content_type",
+            side_effect=partial(_aprobe_content_type_mock, mocking_data["web"]),
+        ),
     ):
         yield
 
 
 # noinspection PyProtectedMember,PyUnusedLocal
 async def _make_openai_request_mock(
-    captured_responses: dict[tuple[tuple[tuple[str, Any], ...], ...], dict[str, Any]],
+    captured_responses: dict[bytes, dict[str, Any]],
     prompt: MessageType,
     streamed_message: _OpenAIStreamedMessage,
     async_openai_client: Optional[Any] = None,
@@ -60,50 +95,55 @@ async def _make_openai_request_mock(
         prompt_key = _convert_prompt_to_captured_key(message_dicts)
         response = captured_responses[prompt_key]
         if stream:
-            tokens = re.split(r"(?<=\S)(?=\s+)", response["content"])
+            tokens = _TOKEN_SPLIT_RE.split(response["content"])
             for token in tokens:
-                data = MagicMock()
-                data.choices[0].delta.content = token
-                data.choices[0].delta.role = response["openai_role"]
-                data.choices[0].message.content = token
-                data.choices[0].message.role = response["openai_role"]
-                data.model_dump.return_value = {
-                    "choices": [
-                        {
-                            "delta": {
-                                "content": token,
-                                "role": response["openai_role"],
-                            }
-                        }
-                    ]
-                }
-                token_producer.send(data)
+                token_producer.send(_build_chat_completion_mock(token, response["openai_role"], "delta"))
         else:
             # send the whole response as a single "token"
-            data = MagicMock()
-            data.choices[0].delta.content = response["content"]
-            data.choices[0].delta.role = response["openai_role"]
-            data.choices[0].message.content = response["content"]
-            data.choices[0].message.role = response["openai_role"]
-            data.model_dump.return_value = {
-                "choices": [
-                    {
-                        "message": {
-                            "content": response["content"],
-                            "role": response["openai_role"],
-                        }
-                    }
-                ]
-            }
-            token_producer.send(data)
-
-
-def _get_serpapi_results_mock(
+            token_producer.send(_build_chat_completion_mock(response["content"], response["openai_role"], "message"))
+
+
+@dataclass(slots=True)
+class _MessageMock:
+    content: str
+    role: str
+
+
+@dataclass(slots=True)
+class _ChoiceMock:
+    delta: _MessageMock
+    message: _MessageMock
+
+
+@dataclass(slots=True)
+class _ChatCompletionMock:
+    choices: list[_ChoiceMock]
+    dumped: dict[str, Any]
+
+    def model_dump(self) -> dict[str, Any]:
+        """
+        Mimic pydantic's model_dump() of an OpenAI chat completion (chunk).
+        """
+        return self.dumped
+
+
+def _build_chat_completion_mock(content: str, role: str, dumped_key: str) -> _ChatCompletionMock:
+    # plain dataclasses instead of MagicMock - MagicMock creates child mocks and records calls on every attribute
+    # access, which adds up for every single streamed token
+    message = _MessageMock(content=content, role=role)
+    return _ChatCompletionMock(
+        choices=[_ChoiceMock(delta=message, message=message)],
+        dumped={"choices": [{dumped_key: {"content": content, "role": role}}]},
+    )
+
+
+async def _arequest_serpapi_results_mock(
     captured_responses: dict[tuple[str, bool], list[dict[str, Any]]],
     query: str,
     remove_gaia_links: bool = REMOVE_GAIA_LINKS,
 ) -> list[dict[str, Any]]:
-    return copy.deepcopy(captured_responses[(query, remove_gaia_links)])
+    # the results are only read (never mutated) downstream, so there is no need to copy them
+    return captured_responses[(query, remove_gaia_links)]
 
 
 async def _adownload_from_web_mock(captured_responses: dict[str, tuple[str, str]], url: str) -> tuple[str, bool]:
@@ -120,32 +160,48 @@ async def _adownload_from_web_mock(captured_responses: dict[str, tuple[str, str]
     return content, False
 
 
-def _convert_prompt_to_captured_key(prompt: Iterable[dict[str, Any]]) -> tuple[tuple[tuple[str, Any], ...], ...]:
+async def _aprobe_content_type_mock(captured_responses: dict[str, tuple[str, str]], url: str) -> tuple[str, int]:
+    # urls that were never downloaded during capturing are treated as if the server didn't report their content type
+    content_type, _ = captured_responses.get(url, ("", None))
+    return content_type, 0
+
+
+def _convert_prompt_to_captured_key(prompt: Iterable[dict[str, Any]]) -> bytes:
     """
-    Convert the prompt to a key for the captured response dictionary.
+    Convert the prompt to a key for the captured response dictionary (a hash of the prompt, so the key is cheap to
+    compare no matter how big the prompt is).
     """
-    return tuple(tuple(sorted(d.items())) for d in prompt)
+    prompt_json = json.dumps(list(prompt), sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(prompt_json.encode("utf-8"), digest_size=16).digest()
 
 
 def _load_gaia_mocking_data() -> dict[str, Any]:
     mocking_data_dir = Path("../gaia_mocking_data")
-    sys.path.append(str(mocking_data_dir))
 
     mocking_data = {
         "openai": {},
         "serpapi": {},
         "web": {},
     }
-    module_files = glob("*.py", root_dir=mocking_data_dir)
-    for module_file in module_files:
-        module = importlib.import_module(module_file[:-3])
-        for openai_response in module.CAPTURED["openai"]:
+    for module_file in mocking_data_dir.glob("*.py"):
+        captured = _read_captured_data(module_file)
+        for openai_response in captured["openai"]:
             prompt_key = _convert_prompt_to_captured_key(openai_response["prompt"])
             mocking_data["openai"][prompt_key] = openai_response["response"]
-        for serpapi_response in module.CAPTURED["serpapi"]:
+        for serpapi_response in captured["serpapi"]:
             serpapi_key = (serpapi_response["query"], serpapi_response["remove_gaia_links"])
             mocking_data["serpapi"][serpapi_key] = serpapi_response["organic_results"]
-        for web_response in module.CAPTURED["web"]:
+        for web_response in captured["web"]:
             mocking_data["web"][web_response["url"]] = (web_response["content_type"], web_response["content"])
 
     return mocking_data
+
+
+def _read_captured_data(module_file: Path) -> dict[str, Any]:
+    """
+    Read the CAPTURED literal from a file with mocking data. The file is parsed as data rather than imported, so
+    nothing is executed, compiled to bytecode or registered in sys.modules.
+    """
+    module_source = module_file.read_text(encoding="utf-8")
+    _, captured_literal = module_source.split("=", 1)
+    return ast.literal_eval(captured_literal.strip())
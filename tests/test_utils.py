@@ -0,0 +1,89 @@
+"""
+Unit tests for the pure helper functions in forum_versus_gaia.utils.
+"""
+
+from forum_versus_gaia.utils import clean_pdf_pages, convert_html_to_markdown, is_pdf_url, normalize_url
+
+
+def test_textless_link_does_not_hide_the_same_link_with_text():
+    """
+    Test that a thumbnail link without text doesn't prevent the title link that follows it from keeping its url.
+    """
+    html = '<a href="/book/24372"><img></a><h3><a href="/book/24372">World Building</a></h3>'
+    assert (
+        convert_html_to_markdown(html, baseurl="https://muse.jhu.edu/search")
+        == "[World Building](https://muse.jhu.edu/book/24372)"
+    )
+
+
+def test_repeated_links_are_reduced_to_text():
+    """
+    Test that only the first occurrence of a link keeps its url.
+    """
+    html = '<p><a href="https://example.com/a">First</a></p><p><a href="https://example.com/a">Again</a></p>'
+    assert convert_html_to_markdown(html) == "[First](https://example.com/a)\nAgain"
+
+
+def test_non_http_links_are_reduced_to_text():
+    """
+    Test that mailto: and javascript: links keep only their text.
+    """
+    html = '<p><a href="mailto:someone@example.com">Mail us</a></p><p><a href="javascript:void(0)">Menu</a></p>'
+    assert convert_html_to_markdown(html) == "Mail us\nMenu"
+
+
+def test_textless_pdf_links_are_kept():
+    """
+    Test that links without text are dropped unless they lead to a PDF.
+    """
+    html = '<a href="/thumbnail"><img></a><a href="/paper.pdf"><img></a>'
+    assert convert_html_to_markdown(html, baseurl="https://example.com/") == "[](https://example.com/paper.pdf)"
+
+
+def test_is_pdf_url():
+    """
+    Test that PDF urls are recognized by their path regardless of the query string and letter case.
+    """
+    assert is_pdf_url(" https://example.com/Paper.PDF?download=1 ")
+    assert not is_pdf_url("https://example.com/pdf/1234")
+
+
+def test_normalize_url():
+    """
+    Test that the same url written slightly differently is normalized to the same string.
+    """
+    assert normalize_url(" https://Example.COM/Path#section ") == normalize_url("https://example.com/Path")
+
+
+def test_clean_pdf_pages_removes_only_page_numbers_in_sequence():
+    """
+    Test that only the digit-only lines that follow the sequence of the pages are removed as page numbers.
+    """
+    page_texts = ["Population\n7364570\nTotal\n\n1", "12\nMen\n3586571\nTotal\n2"]
+    assert clean_pdf_pages(page_texts) == ["Population\n7364570\nTotal", "12\nMen\n3586571\nTotal"]
+
+
+def test_clean_pdf_pages_keeps_numbers_without_sequence():
+    """
+    Test that digit-only lines at the edges of pages are kept if they don't follow the sequence of the pages.
+    """
+    page_texts = ["Population\n2011\n7364570\n\n1", "12\nMen\n3586571"]
+    assert clean_pdf_pages(page_texts) == ["Population\n2011\n7364570\n1", "12\nMen\n3586571"]
+
+
+def test_clean_pdf_pages_removes_headers_and_footers():
+    """
+    Test that lines repeated on more than half of the pages are removed together with the page numbers next to them.
+    """
+    page_texts = [f"Census Report\nPage text {i}\n{i}" for i in range(1, 6)]
+    assert clean_pdf_pages(page_texts) == [f"Page text {i}" for i in range(1, 6)]
+
+
+def test_clean_pdf_pages_keeps_repeated_lines_inside_pages():
+    """
+    Test that table labels repeated on every page are not mistaken for headers/footers.
+    """
+    page_texts = [f"Census Report\nRegion {i}\nMen\n{100 + i}\nTotal\n{200 + i}\nSource {i}\n{i}" for i in range(1, 6)]
+    assert clean_pdf_pages(page_texts) == [
+        f"Region {i}\nMen\n{100 + i}\nTotal\n{200 + i}\nSource {i}" for i in range(1, 6)
+    ]